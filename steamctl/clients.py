@@ -1,17 +1,34 @@
+import gevent
 import gevent.monkey
 gevent.monkey.patch_socket()
 gevent.monkey.patch_ssl()
 
 import os
+import lzma
+import struct
+import random
 import logging
+from io import BytesIO
+from contextlib import contextmanager
+from bisect import bisect_right
+from urllib.parse import urlparse
 from time import time
+from zipfile import ZipFile
+from binascii import crc32
+from hashlib import sha1
+from gevent.event import AsyncResult
+from gevent.pool import Pool as GPool
+from gevent.threadpool import ThreadPool
+from cachetools import LRUCache
 from steam.enums import EResult, EPersonaState
 from steam.client import SteamClient, _cli_input, getpass
 from steam.client.cdn import CDNClient, CDNDepotManifest, CDNDepotFile, ContentServer
 from steam.exceptions import SteamError
-from steam.core.crypto import sha1_hash
+from steam.core.crypto import sha1_hash, symmetric_decrypt
 
 from steamctl.utils.format import fmt_size
+from steamctl.utils.metrics import metrics
+from steamctl.utils.concurrency import apply_returning_errors
 from steamctl.utils.storage import (UserCacheFile, UserDataFile,
                                     UserCacheDirectory, UserDataDirectory,
                                     ensure_dir, sanitizerelpath
@@ -19,6 +36,51 @@ from steamctl.utils.storage import (UserCacheFile, UserDataFile,
 
 cred_dir = UserDataDirectory('client')
 
+
+def decode_chunk(data, depot_key, chunk_id):
+    """Decrypt, decompress and checksum a chunk as served by the CDN
+
+    AES, LZMA, zlib and SHA1 all release the GIL, so this can run in a thread pool
+    and scale with the number of cores.
+
+    :param data: encrypted chunk
+    :type  data: bytes
+    :param depot_key: depot decryption key
+    :type  depot_key: bytes
+    :param chunk_id: chunk sha1 in hex
+    :type  chunk_id: str
+    :returns: chunk data
+    :rtype: bytes
+    :raises SteamError: on invalid chunk
+    """
+    start = time()
+    data = symmetric_decrypt(data, depot_key)
+
+    if data[:2] == b'VZ':
+        if data[-2:] != b'zv':
+            raise SteamError("VZ: Invalid footer: %s" % repr(data[-2:]))
+        if data[2:3] != b'a':
+            raise SteamError("VZ: Invalid version: %s" % repr(data[2:3]))
+
+        vzfilter = lzma._decode_filter_properties(lzma.FILTER_LZMA1, data[7:12])
+        vzdec = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[vzfilter])
+        checksum, decompressed_size = struct.unpack('<II', data[-10:-2])
+        # see CDNClient.get_chunk, lzma output can be longer or shorter than expected
+        data = vzdec.decompress(memoryview(data)[12:-9])[:decompressed_size]
+
+        if crc32(data) != checksum:
+            raise SteamError("VZ: CRC32 checksum doesn't match for decompressed data")
+    else:
+        with ZipFile(BytesIO(data)) as zf:
+            data = zf.read(zf.filelist[0])
+
+    if sha1(data).hexdigest() != chunk_id.lower():
+        raise SteamError("Chunk %s checksum doesn't match" % chunk_id)
+
+    metrics.observe('steamctl_decode_seconds', time() - start)
+
+    return data
+
 class CachingSteamClient(SteamClient):
     credential_location = cred_dir.path
     persona_state = EPersonaState.Offline
@@ -36,8 +98,8 @@ class CachingSteamClient(SteamClient):
         with UserDataFile('client/%s.key' % self.username).open('w') as fp:
             fp.write(self.login_key)
 
-    def get_cdnclient(self):
-        return CachingCDNClient(self)
+    def get_cdnclient(self, **kwargs):
+        return CachingCDNClient(self, **kwargs)
 
     def login_from_args(self, args, print_status=True):
         result = None
@@ -200,6 +262,67 @@ class CachingSteamClient(SteamClient):
 
 class CTLDepotFile(CDNDepotFile):
     _LOG = logging.getLogger('CTLDepotFile')
+    read_ahead = 4  #: chunks fetched in the background while the file is read sequentially
+    _chunk_offsets = None
+    _read_end = 0
+    _prefetched = 0
+
+    def _sorted_chunks(self):
+        # sorted on first read only, as instances are made for every file in a manifest
+        if self._chunk_offsets is None:
+            self._chunks = sorted(self.chunks, key=lambda chunk: chunk.offset)
+            self._chunk_offsets = [chunk.offset for chunk in self._chunks]
+
+        return self._chunks
+
+    def _prefetch(self, chunk):
+        try:
+            self.manifest.cdn_client.get_chunk(self.manifest.app_id,
+                                               self.manifest.depot_id,
+                                               chunk.sha.hex(),
+                                               )
+        except Exception as exp:
+            self._LOG.debug("Read-ahead failed for chunk %s: %s", chunk.sha.hex(), exp)
+
+    def read(self, length=-1):
+        """Read bytes from the file
+
+        Chunks are kept in the CDN client's chunk cache, so reopening the file or
+        seeking back doesn't fetch them again. While reads are sequential, the next
+        :attr:`read_ahead` chunks are fetched in the background.
+
+        :param length: number of bytes to read. Read the whole file if not set
+        :type  length: int
+        :returns: file data
+        :rtype: bytes
+        """
+        end = self.size if length < 0 else min(self.size, self.offset + length)
+
+        if self.offset >= end:
+            return b''
+
+        chunks = self._sorted_chunks()
+        sequential = self.offset == self._read_end
+        index = bisect_right(self._chunk_offsets, self.offset) - 1
+        offset = offset_start = self.offset
+        parts = []
+
+        while offset < end:
+            chunk = chunks[index]
+            data = self._get_chunk(chunk)
+            parts.append(data[offset - chunk.offset:end - chunk.offset])
+            offset = chunk.offset + chunk.cb_original
+            index += 1
+
+        if sequential and self.read_ahead:
+            for chunk in chunks[max(index, self._prefetched):index + self.read_ahead]:
+                gevent.spawn(self._prefetch, chunk)
+
+            self._prefetched = max(self._prefetched, index + self.read_ahead)
+
+        metrics.inc('steamctl_read_bytes_total', end - offset_start)
+        self.offset = self._read_end = end
+        return parts[0] if len(parts) == 1 else b''.join(parts)
 
     def download_to(self, target, no_make_dirs=False, pbar=None, verify=True):
         relpath = sanitizerelpath(self.filename)
@@ -260,26 +383,359 @@ class CTLDepotFile(CDNDepotFile):
                 if pbar:
                     pbar.update(chunk.cb_original)
 
+    def stream(self, offset=0, length=None, read_ahead=8):
+        """Yields file data from ``offset`` in order, while up to ``read_ahead``
+        chunks are fetched concurrently
+
+        :param offset: file offset to start from
+        :type  offset: int
+        :param length: number of bytes, ``None`` for until the end of the file
+        :type  length: int
+        :param read_ahead: number of chunks fetched concurrently
+        :type  read_ahead: int
+        """
+        end = self.size if length is None else min(self.size, offset + length)
+        chunks = [chunk for chunk in sorted(self.chunks, key=lambda chunk: chunk.offset)
+                  if chunk.offset < end and chunk.offset + chunk.cb_original > offset]
+
+        def fetch(chunk):
+            return chunk, self.manifest.cdn_client.get_chunk(self.manifest.app_id,
+                                                             self.manifest.depot_id,
+                                                             chunk.sha.hex(),
+                                                             )
+
+        pool = GPool(read_ahead)
+
+        try:
+            for chunk, data in pool.imap(fetch, chunks, maxsize=read_ahead):
+                data = data[max(offset - chunk.offset, 0):end - chunk.offset]
+                metrics.inc('steamctl_read_bytes_total', len(data))
+                yield data
+        finally:
+            pool.kill()
+
 class CTLDepotManifest(CDNDepotManifest):
     DepotFileClass = CTLDepotFile
 
 
+class ContentServerStats(object):
+    """Latency and throughput statistics for content servers, persisted per cell id
+
+    Servers are ranked by the estimated time to fetch an average chunk. Servers that
+    error are demoted for an exponentially increasing amount of time.
+
+    :param cell_id: cell id the statistics are for
+    :type  cell_id: int
+    """
+    alpha = 0.3                 #: weight of a new sample in the moving averages
+    chunk_size = 1024**2        #: chunk size used to estimate fetch time
+    demote_time = 30            #: base demotion time in seconds
+    max_age = 7 * 24 * 60 * 60  #: discard statistics not updated in this many seconds
+
+    def __init__(self, cell_id):
+        self.cell_id = cell_id
+        self._file = UserDataFile('cs_stats.json')
+        self._changed = False
+
+        now = time()
+        data = (self._file.read_json() or {}).get(str(cell_id), {})
+        self.servers = {key: entry for key, entry in data.items()
+                        if entry.get('updated', 0) + self.max_age > now
+                        }
+
+    def __repr__(self):
+        return "%s(cell_id=%r, servers=%r)" % (
+            self.__class__.__name__,
+            self.cell_id,
+            len(self.servers),
+            )
+
+    @staticmethod
+    def key(server):
+        return "%s:%s" % (server.host, server.port)
+
+    def _entry(self, server):
+        key = self.key(server)
+
+        if key not in self.servers:
+            self.servers[key] = {'latency': None, 'throughput': None, 'errors': 0,
+                                 'demoted_until': 0, 'updated': 0}
+
+        return self.servers[key]
+
+    def _average(self, current, sample):
+        if current is None:
+            return sample
+        return current + (sample - current) * self.alpha
+
+    def record(self, server, latency, nbytes=0, elapsed=0):
+        """Record a successful response
+
+        :param latency: seconds until the response headers arrived
+        :param nbytes: size of the response body
+        :param elapsed: seconds until the response body was read
+        """
+        entry = self._entry(server)
+        entry['latency'] = self._average(entry['latency'], latency)
+
+        if nbytes and elapsed > 0:
+            entry['throughput'] = self._average(entry['throughput'], nbytes / elapsed)
+
+        entry['errors'] = 0
+        entry['updated'] = int(time())
+        self._changed = True
+
+    def record_error(self, server):
+        """Record a failed request, and demote the server"""
+        entry = self._entry(server)
+        entry['errors'] += 1
+        entry['updated'] = int(time())
+        self.demote(server, self.demote_time * 2 ** min(entry['errors'] - 1, 5))
+
+    def demote(self, server, seconds):
+        entry = self._entry(server)
+        entry['demoted_until'] = max(entry['demoted_until'], int(time() + seconds))
+        self._changed = True
+
+    def is_demoted(self, server):
+        entry = self.servers.get(self.key(server))
+        return bool(entry) and entry['demoted_until'] > time()
+
+    def estimate(self, server):
+        """Estimated seconds to fetch a chunk, or ``None`` when there is no data"""
+        entry = self.servers.get(self.key(server))
+
+        if not entry or entry['latency'] is None:
+            return None
+
+        estimate = entry['latency']
+
+        if entry['throughput']:
+            estimate += self.chunk_size / entry['throughput']
+
+        return estimate
+
+    def best_latency(self, servers):
+        latencies = [self.servers[self.key(server)]['latency']
+                     for server in servers
+                     if self.key(server) in self.servers
+                     and self.servers[self.key(server)]['latency'] is not None
+                     ]
+        return min(latencies) if latencies else None
+
+    def rank(self, servers):
+        """Sort servers from best to worst. Servers without statistics are placed
+        alongside the median server, so they get a chance to be measured.
+        Demoted servers come last, the one with the nearest recovery first
+        """
+        estimates = {self.key(server): self.estimate(server) for server in servers}
+        known = sorted(value for value in estimates.values() if value is not None)
+        median = known[len(known) // 2] if known else 0
+
+        def sort_key(server):
+            if self.is_demoted(server):
+                return (1, self.servers[self.key(server)]['demoted_until'])
+
+            estimate = estimates[self.key(server)]
+            return (0, median if estimate is None else estimate)
+
+        return sorted(servers, key=sort_key)
+
+    def save(self):
+        if not self._changed:
+            return
+
+        data = self._file.read_json() or {}
+        data[str(self.cell_id)] = self.servers
+        self._file.write_json(data)
+        self._changed = False
+
+
 class CachingCDNClient(CDNClient):
     DepotManifestClass = CTLDepotManifest
     _LOG = logging.getLogger('CachingCDNClient')
     _depot_keys = None
     skip_licenses = False
-
-    def __init__(self, *args, **kwargs):
+    chunk_store = None  #: optional :class:`.ChunkStore` checked before going to the CDN
+    offline = False     #: serve chunks only from the chunk store, never connect to CDN
+    stripe_width = 4    #: number of best ranked servers requests are spread across
+    slow_factor = 4     #: demote servers responding this many times slower than the best
+    rate_limiter = None #: optional :class:`.RateLimiter` for CDN requests
+    chunk_cache_size = 64 * 1024**2  #: bytes of decoded chunks kept in memory for reuse
+    max_retries = 8     #: attempts at a request before giving up
+    retry_backoff = 0.5 #: seconds before the first retry, doubles for each retry after
+    retry_backoff_max = 30  #: upper limit for the time between retries
+    _decode_pool = None
+
+    def __init__(self, *args, chunk_store=None, offline=False, rate_limiter=None,
+                 decode_threads=None, **kwargs):
+        self._chunk_requests = {}
+        self.decode_threads = decode_threads or os.cpu_count() or 4  #: threads to decode chunks with
+        self._stripe = 0
+        self.chunk_store = chunk_store
+        self.offline = offline
+        self.rate_limiter = rate_limiter
+        self._chunk_cache = LRUCache(self.chunk_cache_size, getsizeof=len)
         CDNClient.__init__(self, *args, **kwargs)
+        self.server_stats = ContentServerStats(self.cell_id)
+
+    def get_content_server(self, rotate=False):
+        # spread requests across the best ranked servers, and fail over to
+        # demoted servers only when there is nothing else left
+        ranked = self.server_stats.rank(self.servers)
+        ranked = ([server for server in ranked[:self.stripe_width]
+                   if not self.server_stats.is_demoted(server)]
+                  or ranked[:1])
+        self._stripe = (self._stripe + 1) % len(ranked)
+        return ranked[self._stripe]
+
+    def _retry_delay(self, attempt):
+        # exponential backoff with full jitter, so failed requests don't retry in lockstep
+        return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
+
+    def cdn_cmd(self, command, args):
+        # failed requests are retried on the next server, while the one that
+        # failed is demoted for longer each time it keeps failing
+        for attempt in range(self.max_retries):
+            if attempt:
+                gevent.sleep(self._retry_delay(attempt - 1))
+
+            server = self.get_content_server()
+            url = "%s://%s:%s/%s/%s" % (
+                'https' if server.https else 'http',
+                server.host,
+                server.port,
+                command,
+                args,
+                )
+
+            start = time()
+
+            try:
+                resp = self.web.get(url, timeout=10)
+                nbytes = len(resp.content)
+            except Exception as exp:
+                self._LOG.debug("Request error (%s): %s", server.host, exp)
+                self.server_stats.record_error(server)
+                metrics.inc('steamctl_retries_total', server=server.host)
+                error = exp
+                continue
+
+            if resp.ok:
+                best = self.server_stats.best_latency(self.servers)
+                latency = resp.elapsed.total_seconds()
+                self.server_stats.record(server, latency, nbytes, time() - start)
+                metrics.observe('steamctl_request_seconds', latency, server=server.host)
+                metrics.inc('steamctl_fetched_bytes_total', nbytes, source='cdn')
+
+                if best and latency > best * self.slow_factor:
+                    self._LOG.debug("Demoting slow server %s (%.3fs)", server.host, latency)
+                    self.server_stats.demote(server, self.server_stats.demote_time)
+
+                if self.rate_limiter:
+                    self.rate_limiter.consume(nbytes)
+
+                return resp
+            elif 400 <= resp.status_code < 500:
+                self._LOG.debug("Got HTTP %s", resp.status_code)
+                raise SteamError("HTTP Error %s" % resp.status_code)
+
+            self._LOG.debug("Got HTTP %s from %s", resp.status_code, server.host)
+            self.server_stats.record_error(server)
+            metrics.inc('steamctl_retries_total', server=server.host)
+            error = "HTTP Error %s" % resp.status_code
+
+        raise SteamError("Request for %s failed after %s attempts: %s" % (args, self.max_retries, error))
+
+    def get_chunk(self, app_id, depot_id, chunk_id):
+        key = (depot_id, chunk_id)
+
+        # concurrent requests for the same chunk wait on a single fetch
+        if key in self._chunk_requests:
+            return self._chunk_requests[key].get()
+
+        self._chunk_requests[key] = result = AsyncResult()
+
+        try:
+            data = self._get_chunk(app_id, depot_id, chunk_id)
+        except Exception as exp:
+            result.set_exception(exp)
+            raise
+        else:
+            result.set(data)
+            return data
+        finally:
+            del self._chunk_requests[key]
+
+    def _cache_chunk(self, depot_id, chunk_id, data):
+        if len(data) <= self._chunk_cache.maxsize:
+            self._chunk_cache[(depot_id, chunk_id)] = data
+
+    def _get_chunk(self, app_id, depot_id, chunk_id):
+        if (depot_id, chunk_id) in self._chunk_cache:
+            data = self._chunk_cache[(depot_id, chunk_id)]
+            metrics.inc('steamctl_reused_bytes_total', len(data), source='memory')
+            return data
+
+        # decode and access the chunk store off the event loop, so many chunks can be handled in parallel
+        if self._decode_pool is None:
+            self._decode_pool = ThreadPool(self.decode_threads)
+
+        if self.chunk_store:
+            data, exp = apply_returning_errors(self._decode_pool, self.chunk_store.get, depot_id, chunk_id)
+
+            if exp is not None:
+                self._LOG.debug("Failed reading chunk %s from the chunk store: %s", chunk_id, exp)
+            elif data is not None:
+                metrics.inc('steamctl_reused_bytes_total', len(data), source='chunk_store')
+                self._cache_chunk(depot_id, chunk_id, data)
+                return data
+
+        if self.offline:
+            raise SteamError("Chunk %s (depot %s) is not in the chunk store" % (chunk_id, depot_id))
+
+        depot_key = self.get_depot_key(app_id, depot_id)
+
+        # a chunk that fails to decode was corrupted on the way, fetch it again
+        for attempt in range(self.max_retries):
+            if attempt:
+                gevent.sleep(self._retry_delay(attempt - 1))
+
+            resp = self.cdn_cmd('depot', '%s/chunk/%s' % (depot_id, chunk_id))
+
+            data, exp = apply_returning_errors(self._decode_pool, decode_chunk, resp.content, depot_key, chunk_id)
+
+            if exp is None:
+                break
+
+            self._LOG.debug("Chunk %s from %s is invalid: %s", chunk_id, resp.url, exp)
+            metrics.inc('steamctl_retries_total', server=urlparse(resp.url).hostname)
+        else:
+            raise SteamError("Chunk %s (depot %s) is invalid after %s attempts: %s" % (
+                                chunk_id, depot_id, self.max_retries, exp))
+
+        self._cache_chunk(depot_id, chunk_id, data)
+
+        if self.chunk_store:
+            _, exp = apply_returning_errors(self._decode_pool, self.chunk_store.put, depot_id, chunk_id, data)
+
+            if exp is not None:
+                self._LOG.debug("Failed storing chunk %s: %s", chunk_id, exp)
+
+        return data
 
     def fetch_content_servers(self, *args, **kwargs):
+        if self.offline:
+            return
+
         cached_cs = UserDataFile('cs_servers.json')
 
         data = cached_cs.read_json()
 
-        # load from cache, only keep for 5 minutes
-        if data and (data['timestamp'] + 300) > time():
+        # load from cache, only keep for 5 minutes, and only for the same cell id
+        if (data
+           and (data['timestamp'] + 300) > time()
+           and data.get('cell_id') == self.cell_id):
             for server in data['servers']:
                 entry = ContentServer()
                 entry.__dict__.update(server)
@@ -313,7 +769,23 @@ class CachingCDNClient(CDNClient):
                 for depot_id, key in (UserDataFile('depot_keys.json').read_json() or {}).items()
                 }
 
+    @contextmanager
+    def closing(self):
+        """Context manager that saves the caches and disconnects the Steam client on exit.
+        Also when the command failed, so the server stats are kept
+        """
+        try:
+            yield self
+        finally:
+            self.save_cache()
+            self.steam.disconnect()
+
     def save_cache(self):
+        if self.chunk_store:
+            self.chunk_store.prune()
+
+        self.server_stats.save()
+
         cached_depot_keys = self.get_cached_depot_keys()
 
         if cached_depot_keys == self.depot_keys:
@@ -390,6 +862,17 @@ class CachingCDNClient(CDNClient):
                 self._LOG.debug("Found cached manifest, but encountered error or file is empty")
                 cached_manifest.remove()
 
+    def get_manifest_request_code(self, app_id, depot_id, manifest_gid, *args, **kwargs):
+        # request code is only needed when we have to fetch the manifest from CDN
+        if ((app_id, depot_id, manifest_gid) in self.manifests
+           or UserCacheFile("manifests/{}_{}_{}".format(app_id, depot_id, manifest_gid)).exists()):
+            return 0
+
+        if self.offline:
+            raise SteamError("Manifest %s (depot %s) is not cached" % (manifest_gid, depot_id))
+
+        return CDNClient.get_manifest_request_code(self, app_id, depot_id, manifest_gid, *args, **kwargs)
+
     def get_manifest(self, app_id, depot_id, manifest_gid, decrypt=True, manifest_request_code=None):
         key = (app_id, depot_id, manifest_gid)
         cached_manifest = UserCacheFile("manifests/{}_{}_{}".format(*key))
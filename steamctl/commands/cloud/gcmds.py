@@ -11,6 +11,7 @@ import os
 import sys
 import logging
 from contextlib import contextmanager
+from urllib.parse import urlparse
 from steam.exceptions import SteamError
 from steam.client import EResult, EMsg, MsgProto, SteamID
 from steamctl.clients import CachingSteamClient
@@ -19,6 +20,10 @@ from steamctl.utils.tqdm import tqdm, fake_tqdm
 from steamctl.utils.format import fmt_size
 from steamctl.utils.storage import ensure_dir, sanitizerelpath
 from steamctl.utils.apps import get_app_names
+from steamctl.utils.concurrency import AdaptiveConcurrency
+from steamctl.utils.ratelimit import make_rate_limiter
+from steamctl.utils.writer import WriteBehind
+from steamctl.utils.metrics import metrics, export_metrics
 
 LOG = logging.getLogger(__name__)
 
@@ -90,14 +95,9 @@ def cmd_cloud_list_apps(args):
                     )
                  )
 
-def download_file(args, sess, file, pbar_size, pbar_files):
-    fstream = sess.get(file.url, stream=True)
+def download_file(args, sess, file, pbar_size, pbar_files, connections, limiter, writer):
     filename = file.filename
 
-    if fstream.status_code != 200:
-        LOG.error("Failed to download: {}".format(filename))
-        return 1 # error
-
     relpath = sanitizerelpath(filename)
     # ensure there is a / after %vars%, and replace % with _
     relpath = re.sub(r'^%([A-Za-z0-9]+)%', r'_\1_/', relpath)
@@ -105,16 +105,36 @@ def download_file(args, sess, file, pbar_size, pbar_files):
     relpath = os.path.join(args.output, relpath)
 
     filepath = os.path.abspath(relpath)
-    ensure_dir(filepath)
 
-    with open(filepath, 'wb') as fp:
-        for chunk in iter(lambda: fstream.raw.read(8388608), b''):
-            fp.write(chunk)
-            pbar_size.update(len(chunk))
+    with connections.request() as request:
+        fstream = sess.get(file.url, stream=True)
+        metrics.observe('steamctl_request_seconds', fstream.elapsed.total_seconds(), server=urlparse(file.url).hostname)
+
+        if fstream.status_code != 200:
+            LOG.error("Failed to download: {}".format(filename))
+            return 1 # error
+
+        ensure_dir(filepath)
+
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+        offset = 0
+
+        try:
+            for chunk in iter(lambda: fstream.raw.read(limiter.read_size(8388608)), b''):
+                writer.write(fd, chunk, offset)
+                offset += len(chunk)
+                request.nbytes += len(chunk)
+                metrics.inc('steamctl_fetched_bytes_total', len(chunk), source='http')
+                pbar_size.update(len(chunk))
+                limiter.consume(len(chunk))
+        finally:
+            writer.close(fd)
 
     pbar_files.update(1)
 
 def cmd_cloud_download(args):
+    export_metrics(args)
+
     with init_client(args) as s:
         files, total_files, total_size = get_cloud_files(s, args.app_id)
 
@@ -127,14 +147,19 @@ def cmd_cloud_download(args):
             pbar = fake_tqdm()
             pbar2 = fake_tqdm()
 
-        tasks = GPool(6)
+        connections = AdaptiveConcurrency(initial=6, maximum=args.max_connections)
+        tasks = GPool(connections.maximum)
+        limiter = make_rate_limiter(args)
+        writer = WriteBehind()
         sess = make_requests_session()
 
         for entry in files:
-            tasks.spawn(download_file, args, sess, entry, pbar, pbar2)
+            tasks.spawn(download_file, args, sess, entry, pbar, pbar2, connections, limiter, writer)
 
         tasks.join()
 
         pbar.refresh()
         pbar2.refresh()
         pbar.close()
+
+        LOG.info("Settled on %s concurrent connections", connections.limit)
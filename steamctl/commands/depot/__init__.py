@@ -2,6 +2,7 @@
 import argparse
 from steamctl.argparser import register_command
 from steamctl.utils.storage import UserDataFile, UserCacheFile
+from steamctl.utils.format import parse_size, parse_rate, parse_schedule
 from argcomplete import warn
 
 
@@ -27,6 +28,30 @@ Examples:
     Download all files for an app to a directory called 'temp':
         {prog} depot download --app 570 -o ./temp
 
+    Update an install of depot 570 from an older manifest, downloading only changed chunks:
+        {prog} depot download --app 570 --depot 570 --from-manifest 7280959080077824592 -o ./temp
+
+    Rebuild an install without network, using chunks from previous downloads with --chunk-store:
+        {prog} depot download --app 570 --depot 570 --manifest 7280959080077824592 --offline-from-store -o ./temp
+
+    Print a file from inside a VPK:
+        {prog} depot cat --app 570 --depot 373301 game/dota/pak01_dir.vpk:scripts/items/items_game.txt
+
+    Download binaries and configs first, then the rest with the largest files first:
+        {prog} depot download --app 570 --priority 'bin/*' '*.cfg' --order largest -o ./temp
+
+    Stream depot files into a tar archive on stdout, without writing them to disk:
+        {prog} depot download --app 570 --depot 570 --tar - | gzip > depot.tar.gz
+
+    Install a second branch next to the first, linking files that are identical in both:
+        {prog} depot download --app 570 --branch beta --link auto --link-root ./public -o ./beta
+
+    Show what an update would download, and the disk space it needs, as JSON:
+        {prog} depot download --app 570 --depot 570 --plan -o ./temp
+
+    Download limited to 2MB/s during the day, unlimited at night, adjustable by writing a rate to a file:
+        {prog} depot download --app 570 --limit-schedule 08:00-23:00=2MB,23:00-08:00=0 --limit-file ./rate -o ./temp
+
 """
 
 @register_command('depot', help='List and download from Steam depots', epilog=epilog)
@@ -76,11 +101,32 @@ def cmd_parser(cp):
     scp_l.add_argument('--skip-licenses', action='store_true', help='Skip checking for licenses')
     scp_l.add_argument('--long', action='store_true', help='Shows extra info for every file')
     scp_l.add_argument('--vpk', action='store_true', help='Include files inside VPK files')
+    scp_l.add_argument('--ignore-case', action='store_true', help='Match file paths regardless of case')
     fexcl = scp_l.add_mutually_exclusive_group()
     fexcl.add_argument('-n', '--name', type=str, help='Wildcard for matching filepath')
     fexcl.add_argument('-re', '--regex', type=str, help='Reguar expression for matching filepath')
     scp_l.set_defaults(_cmd_func=__name__ + '.gcmds:cmd_depot_list')
 
+    # ---- cat
+    scp_c = sub_cp.add_parser("cat", help="Print a file from depot(s) to stdout")
+    scp_c.add_argument('--cell_id', type=int, help='Cell ID to use for download')
+    scp_c.add_argument('-os', choices=['any', 'windows', 'windows64', 'linux', 'linux64', 'macos'],
+                       default='any',
+                       help='Operating system (Default: any)')
+    scp_c.add_argument('-f', '--file', type=argparse.FileType('rb'), action='append', nargs='+', help='Path to a manifest file')
+    scp_c.add_argument('-a', '--app', type=int, help='App ID')
+    scp_c.add_argument('-d', '--depot', type=int, help='Depot ID')
+    scp_c.add_argument('-m', '--manifest', type=int, help='Manifest GID')
+    scp_c.add_argument('-b', '--branch', type=str, help='Branch name', default='public')
+    scp_c.add_argument('-p', '--password', type=str, help='Branch password')
+    scp_c.add_argument('--skip-depot', type=int, nargs='+', help='Depot IDs to skip')
+    scp_c.add_argument('--skip-login', action='store_true', help='Skip login to Steam')
+    scp_c.add_argument('--skip-licenses', action='store_true', help='Skip checking for licenses')
+    scp_c.add_argument('--ignore-case', action='store_true', help='Match the file path regardless of case')
+    scp_c.add_argument('--read-ahead', type=int, default=8, help='Number of chunks fetched concurrently (default: 8)')
+    scp_c.add_argument('filepath', type=str, help='Path of the file in the depot, or of a file inside a VPK, e.g. game/dota/pak01_dir.vpk:scripts/items/items_game.txt')
+    scp_c.set_defaults(_cmd_func=__name__ + '.gcmds:cmd_depot_cat')
+
     # ---- download
     scp_dl = sub_cp.add_parser("download", help="Download depot files")
     scp_dl.add_argument('--cell_id', type=int, help='Cell ID to use for download')
@@ -90,6 +136,12 @@ def cmd_parser(cp):
     scp_dl.add_argument('-o', '--output', type=str, default='', help='Path to directory for the downloaded files (default: cwd)')
     scp_dl.add_argument('-nd', '--no-directories', action='store_true', help='Do not create directories')
     scp_dl.add_argument('-np', '--no-progress', action='store_true', help='Do not create directories')
+    scp_dl.add_argument('--max-connections', type=int, default=32, help='Upper limit for concurrent connections, the actual number adapts to throughput (default: 32)')
+    scp_dl.add_argument('--limit-rate', type=parse_rate, default=0, metavar='RATE', help='Limit download rate in bytes per second, shared by all connections (e.g. 2MB, 500KiB)')
+    scp_dl.add_argument('--limit-schedule', type=parse_schedule, metavar='SCHEDULE', help='Download rate by time of day, e.g. 08:00-23:00=2MB,23:00-08:00=0 (0 is unlimited). Outside of it --limit-rate applies')
+    scp_dl.add_argument('--limit-file', type=str, metavar='PATH', help='File containing a download rate, overrides the other limits. Re-read when changed, or on SIGHUP')
+    scp_dl.add_argument('--metrics-file', type=str, metavar='PATH', help='Write transfer metrics to PATH, as JSON when it ends with .json, otherwise in Prometheus text format (updated every 15s, for the node_exporter textfile collector)')
+    scp_dl.add_argument('--max-memory', type=parse_size, default='1GB', help='Budget for chunk data held in memory, new chunk fetches wait when it is reached (default: 1GB, 0 for unlimited)')
     scp_dl.add_argument('-f', '--file', type=argparse.FileType('rb'), action='append', nargs='+', help='Path to a manifest file')
     scp_dl.add_argument('-a', '--app', type=int, help='App ID')
     scp_dl.add_argument('-d', '--depot', type=int, help='Depot ID')
@@ -100,7 +152,18 @@ def cmd_parser(cp):
     scp_dl.add_argument('--skip-login', action='store_true', help='Skip login to Steam')
     scp_dl.add_argument('--skip-licenses', action='store_true', help='Skip checking for licenses')
     scp_dl.add_argument('--vpk', action='store_true', help='Include files inside VPK files')
+    scp_dl.add_argument('--ignore-case', action='store_true', help='Match file paths regardless of case')
     scp_dl.add_argument('--skip-verify', action='store_true', help='Do not verify existing files, simply redownload')
+    scp_dl.add_argument('--from-manifest', type=int, metavar='GID', help='Manifest GID currently installed in the output directory. Only changed chunks are downloaded')
+    scp_dl.add_argument('--chunk-store', action='store_true', help='Keep downloaded chunks in a local store, and reuse them on later downloads')
+    scp_dl.add_argument('--chunk-store-size', type=parse_size, default='20GB', help='Size budget for the chunk store, least recently used chunks are removed (default: 20GB, 0 for unlimited)')
+    scp_dl.add_argument('--offline-from-store', action='store_true', help='Download using only cached manifests and the chunk store, without network access')
+    scp_dl.add_argument('--order', choices=['manifest', 'smallest', 'largest', 'directory'], default='manifest', help='Order to download files in (default: manifest)')
+    scp_dl.add_argument('--priority', type=str, nargs='+', action='append', metavar='GLOB', help='Download files matching any GLOB first, and sync them to disk before the rest. Repeat for more priority classes, in order')
+    scp_dl.add_argument('--link', choices=['auto', 'reflink', 'hardlink'], help='Write files with identical content once, and reflink or hardlink the rest (auto: reflink when supported, otherwise hardlink). Hardlinked files are replaced, not modified, on update')
+    scp_dl.add_argument('--link-root', type=str, action='append', metavar='DIR', help='Other install directory to link identical files from, can be repeated. Requires --link')
+    scp_dl.add_argument('--tar', type=str, metavar='PATH', help="Write the files into a tar archive at PATH ('-' for stdout) in manifest order, instead of into --output")
+    scp_dl.add_argument('--plan', action='store_true', help='Print what would be downloaded as JSON, without downloading anything. Existing files are verified')
     fexcl = scp_dl.add_mutually_exclusive_group()
     fexcl.add_argument('-n', '--name', type=str, help='Wildcard for matching filepath')
     fexcl.add_argument('-re', '--regex', type=str, help='Reguar expression for matching filepath')
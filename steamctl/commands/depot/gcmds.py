@@ -4,16 +4,16 @@ gevent.monkey.patch_socket()
 gevent.monkey.patch_select()
 gevent.monkey.patch_ssl()
 
-from gevent.pool import Pool as GPool
-
 import re
 import os
 import sys
+import json
 import logging
+import sqlite3
 from io import open
 from contextlib import contextmanager
 from re import search as re_search
-from fnmatch import fnmatch
+from fnmatch import fnmatch, fnmatchcase
 from binascii import unhexlify
 import vpk
 from steam import webapi
@@ -22,12 +22,15 @@ from steam.enums import EResult, EDepotFileFlag
 from steam.client import EMsg, MsgProto
 from steam.client.cdn import decrypt_manifest_gid_2
 from steamctl.clients import CachingSteamClient, CTLDepotManifest, CTLDepotFile
+from steamctl.downloader import DepotDownloader, TarStreamer, InstallState, STATE_DIR
 from steamctl.utils.web import make_requests_session
 from steamctl.utils.format import fmt_size, fmt_datetime
 from steamctl.utils.tqdm import tqdm, fake_tqdm
+from steamctl.utils.ratelimit import make_rate_limiter
+from steamctl.utils.metrics import export_metrics
 from steamctl.commands.webapi import get_webapi_key
 
-from steamctl.utils.storage import ensure_dir, sanitizerelpath
+from steamctl.utils.storage import ChunkStore, VPKIndexCache
 
 webapi._make_requests_session = make_requests_session
 
@@ -35,8 +38,20 @@ LOG = logging.getLogger(__name__)
 
 # overload VPK with a missing method
 class c_VPK(vpk.VPK):
+    @classmethod
+    def from_index(cls, vpk_path, header, tree, fopen):
+        """Make an instance from header fields and an index parsed before, without reading the VPK file"""
+        fvpk = cls.__new__(cls)
+        fvpk.path_enc = 'utf-8'
+        fvpk.fopen = fopen
+        fvpk.vpk_path = vpk_path
+        fvpk.signature = 0x55aa1234
+        fvpk.__dict__.update(header)
+        fvpk.tree = tree
+        return fvpk
+
     def c_iter_index(self):
-        if self.tree:
+        if self.tree is not None:
             index = self.tree.items()
         else:
             index = self.read_index_iter()
@@ -46,32 +61,129 @@ class c_VPK(vpk.VPK):
 
 # find and cache paths to vpk depot files, and set them up to be read directly from CDN
 class ManifestFileIndex(object):
-    def __init__(self, manifests):
+    """Path index over the files in all manifests, built once on first use
+
+    Exact lookups are a dict lookup. Wildcard and regular expression filters walk a trie of
+    path components, and only test the paths under the literal prefix of the filter.
+    Paths match regardless of ``/`` or ``\\`` separators, and of case unless ``case_sensitive``.
+    When several manifests have the same path, lookups return the last one.
+    """
+    _wildcard = re.compile(r'[*?[]')
+    _regex_special = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    def __init__(self, manifests, case_sensitive=True, vpk_index_cache=True):
         self.manifests = manifests
-        self._path_cache = {}
+        self.case_sensitive = case_sensitive
+        self._paths = None  # key -> [(manifest, file_mapping)]
+        self._tree = None   # nested dicts of path components, the key of a path is under None
+        self._vpk_index_cache = VPKIndexCache() if vpk_index_cache else None
 
-    def _locate_file_mapping(self, path):
-        ref = self._path_cache.get(path, None)
+    def _key(self, path):
+        key = re.sub(r'[\\/]+', '/', path)
+        return key if self.case_sensitive else key.lower()
 
-        if ref:
-            return ref
-        else:
-            self._path_cache[path] = None
+    def index(self):
+        if self._paths is not None:
+            return
 
-            for manifest in self.manifests:
-                try:
-                    foundfile = next(manifest.iter_files(path))
-                except StopIteration:
-                    continue
-                else:
-                    self._path_cache[path] = ref = (manifest, foundfile.file_mapping)
-        return ref
+        self._paths, self._tree = {}, {}
 
-    def index(self, pattern=None, raw=True):
         for manifest in self.manifests:
-            for filematch in manifest.iter_files(pattern):
-                filepath = filematch.filename_raw if raw else filematch.filename
-                self._path_cache[filepath] = (manifest, filematch.file_mapping)
+            for depotfile in manifest.iter_files():
+                key = self._key(depotfile.filename_raw)
+
+                if key not in self._paths:
+                    self._paths[key] = []
+
+                    node = self._tree
+                    for part in key.split('/'):
+                        node = node.setdefault(part, {})
+                    node[None] = key
+
+                self._paths[key].append((manifest, depotfile.file_mapping))
+
+    def _iter_keys(self, node):
+        for part, child in node.items():
+            if part is None:
+                yield child
+            else:
+                yield from self._iter_keys(child)
+
+    def _iter_prefix_paths(self, prefix):
+        self.index()
+
+        *dirs, partial = self._key(prefix).split('/')
+        node = self._tree
+
+        for part in dirs:
+            node = node.get(part)
+            if node is None:
+                return
+
+        for part, child in node.items():
+            if part is not None and part.startswith(partial):
+                for key in self._iter_keys(child):
+                    yield from set(file_mapping.filename.rstrip('\x00 \n\t')
+                                   for _, file_mapping in self._paths[key])
+
+    def iter_prefix(self, prefix):
+        """Yields paths, as they are in the manifests, starting with ``prefix``"""
+        return self._iter_prefix_paths(prefix)
+
+    def iter_glob(self, pattern):
+        """Yields paths matching the wildcard ``pattern``, see :meth:`match`"""
+        wildcard = self._wildcard.search(pattern)
+
+        for path in self._iter_prefix_paths(pattern[:wildcard.start()] if wildcard else pattern):
+            if self.match(path, name=pattern):
+                yield path
+
+    def iter_regex(self, regex):
+        """Yields paths matching the regular expression ``regex``, see :meth:`match`.
+        Only anchored expressions (``^...``) narrow down the paths that are tested
+        """
+        prefix = ''
+
+        if regex.startswith('^') and '|' not in regex:
+            special = self._regex_special.search(regex, 1)
+            end = special.start() if special else len(regex)
+
+            # a quantifier makes the character before it optional
+            if special and special.group() in '*?{':
+                end -= 1
+
+            prefix = regex[1:max(1, end)]
+
+        for path in self._iter_prefix_paths(prefix):
+            if self.match(path, regex=regex):
+                yield path
+
+    def match(self, path, name=None, regex=None):
+        """Whether ``path`` matches the wildcard ``name`` and the regular expression ``regex``.
+        Wildcards match regardless of separators, and both follow ``case_sensitive``
+        """
+        if name and not fnmatchcase(self._key(path), self._key(name)):
+            return False
+        if regex and not re_search(regex, path, 0 if self.case_sensitive else re.IGNORECASE):
+            return False
+        return True
+
+    def select(self, name=None, regex=None):
+        """Returns the set of paths matching ``name`` and ``regex``, or ``None`` without either"""
+        if not name and not regex:
+            return None
+
+        paths = set(self.iter_glob(name)) if name else set(self.iter_regex(regex))
+
+        if name and regex:
+            paths = set(path for path in paths if self.match(path, regex=regex))
+
+        return paths
+
+    def _locate_file_mapping(self, path):
+        self.index()
+        refs = self._paths.get(self._key(path))
+        return refs[-1] if refs else None
 
     def file_exists(self, path):
         return self._locate_file_mapping(path) != None
@@ -83,35 +195,35 @@ class ManifestFileIndex(object):
         raise SteamError("File not found: {}".format(path))
 
     def get_vpk(self, path):
-        return c_VPK(path, fopen=self.get_file)
+        ref = self._locate_file_mapping(path)
 
+        if not ref or not self._vpk_index_cache:
+            return c_VPK(path, fopen=self.get_file)
 
-# vpkfile download task
-def vpkfile_download_to(vpk_path, vpkfile, target, no_make_dirs, pbar):
-    relpath = sanitizerelpath(vpkfile.filepath)
+        # parsed indexes are cached by content, so the same build is only read once
+        sha = ref[1].sha_content
 
-    if no_make_dirs:
-        relpath = os.path.join(target,                     # output directory
-                               os.path.basename(relpath))  # filename from vpk
-    else:
-        relpath = os.path.join(target,         # output directory
-                               vpk_path[:-4],  # vpk path with extention (e.g. pak01_dir)
-                               relpath)        # vpk relative path
+        try:
+            cached = self._vpk_index_cache.get(sha)
+        except sqlite3.Error as exp:
+            LOG.debug("VPK index cache error: %s", exp)
+            return c_VPK(path, fopen=self.get_file)
 
-    filepath = os.path.abspath(relpath)
-    ensure_dir(filepath)
+        if cached is not None:
+            LOG.debug("Using cached VPK index for %s", path)
+            return c_VPK.from_index(path, *cached, fopen=self.get_file)
 
-    LOG.info("Downloading VPK file to {} ({}, crc32:{})".format(relpath,
-                                                                fmt_size(vpkfile.file_length),
-                                                                vpkfile.crc32,
-                                                                ))
+        fvpk = c_VPK(path, fopen=self.get_file)
+        fvpk.read_index()
+        header = {name: getattr(fvpk, name) for name in VPKIndexCache.header_fields if hasattr(fvpk, name)}
+
+        try:
+            self._vpk_index_cache.put(sha, header, fvpk.tree)
+        except sqlite3.Error as exp:
+            LOG.debug("VPK index cache error: %s", exp)
 
-    with open(filepath, 'wb') as fp:
-        for chunk in iter(lambda: vpkfile.read(16384), b''):
-            fp.write(chunk)
+        return fvpk
 
-            if pbar:
-                pbar.update(len(chunk))
 
 @contextmanager
 def init_clients(args):
@@ -120,7 +232,18 @@ def init_clients(args):
     if args.cell_id is not None:
         s.cell_id = args.cell_id
 
-    cdn = s.get_cdnclient()
+    chunk_store = None
+    offline = getattr(args, 'offline_from_store', False)
+
+    if offline:
+        args.skip_login = True
+        args.skip_licenses = True
+
+    if offline or getattr(args, 'chunk_store', False):
+        chunk_store = ChunkStore(max_size=args.chunk_store_size)
+
+    cdn = s.get_cdnclient(chunk_store=chunk_store, offline=offline,
+                          rate_limiter=make_rate_limiter(args))
 
     # short-curcuit everything, if we pass manifest file(s)
     if getattr(args, 'file', None):
@@ -266,11 +389,8 @@ def init_clients(args):
 
     LOG.debug("Got manifests: %r", manifests)
 
-    yield s, cdn, manifests
-
-    # clean and exit
-    cdn.save_cache()
-    s.disconnect()
+    with cdn.closing():
+        yield s, cdn, manifests
 
 def cmd_depot_info(args):
     try:
@@ -324,11 +444,8 @@ def cmd_depot_list(args):
 
     try:
         with init_clients(args) as (_, _, manifests):
-            fileindex = ManifestFileIndex(manifests)
-
-            # pre-index vpk file to speed up lookups
-            if args.vpk:
-                fileindex.index('*.vpk')
+            fileindex = ManifestFileIndex(manifests, case_sensitive=not args.ignore_case)
+            matched = fileindex.select(args.name, args.regex)
 
             for manifest in manifests:
                 LOG.debug("Processing: %r", manifest)
@@ -345,10 +462,7 @@ def cmd_depot_list(args):
                     filepath = mapping.filename.rstrip('\x00 \n\t')
 
                     # filepath filtering
-                    if (   (not args.name and not args.regex)
-                        or (args.name  and fnmatch(filepath, args.name))
-                        or (args.regex and re_search(args.regex, filepath))
-                        ):
+                    if matched is None or filepath in matched:
 
                         # print out for manifest file
                         if not args.long:
@@ -366,11 +480,11 @@ def cmd_depot_list(args):
                         # fast skip VPKs that can't possibly match
                         if args.name and ':' in args.name:
                             pre = args.name.split(':', 1)[0]
-                            if not fnmatch(filepath, pre):
+                            if not fileindex.match(filepath, name=pre):
                                 continue
                         if args.regex and ':' in args.regex:
                             pre = args.regex.split(':', 1)[0]
-                            if not re_search(pre + '$', filepath):
+                            if not fileindex.match(filepath, regex=pre + '$'):
                                 continue
 
                         # scan VPKs, but skip data only ones
@@ -385,10 +499,7 @@ def cmd_depot_list(args):
                                 for vpkfile_path, (_, crc32, _, _, _, size) in fvpk.c_iter_index():
                                     complete_path = "{}:{}".format(filepath, vpkfile_path)
 
-                                    if (   (not args.name and not args.regex)
-                                        or (args.name  and fnmatch(complete_path, args.name))
-                                        or (args.regex and re_search(args.regex, complete_path))
-                                        ):
+                                    if fileindex.match(complete_path, args.name, args.regex):
 
                                         if args.long:
                                             print("{} - size:{:,d} crc32:{}".format(
@@ -405,25 +516,110 @@ def cmd_depot_list(args):
         LOG.error(str(exp))
         return 1  # error
 
+def cmd_depot_cat(args):
+    try:
+        with init_clients(args) as (_, _, manifests):
+            fileindex = ManifestFileIndex(manifests, case_sensitive=not args.ignore_case)
+            output = sys.stdout.buffer
+
+            # file inside a vpk
+            if ':' in args.filepath and args.filepath.split(':', 1)[0].endswith('.vpk'):
+                vpk_path, vpkfile_path = args.filepath.split(':', 1)
+
+                try:
+                    vpkfile = fileindex.get_vpk(vpk_path).get_file(vpkfile_path)
+                except ValueError as exp:
+                    raise SteamError("VPK read error: {}".format(exp))
+                except KeyError:
+                    raise SteamError("File not found: {}".format(args.filepath))
+
+                output.write(vpkfile.preload)
+
+                # the rest of the file is in one of the archives
+                if vpkfile.file_length:
+                    stream = fileindex.get_file(vpkfile.vpk_path).stream(vpkfile.archive_offset,
+                                                                         vpkfile.file_length,
+                                                                         args.read_ahead,
+                                                                         )
+                else:
+                    stream = ()
+            else:
+                stream = fileindex.get_file(args.filepath).stream(read_ahead=args.read_ahead)
+
+            for data in stream:
+                output.write(data)
+
+            output.flush()
+    except SteamError as exp:
+        LOG.error(str(exp))
+        return 1  # error
+    except BrokenPipeError:
+        # reader went away (e.g. head), stop writing to the pipe
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1  # error
+
 def cmd_depot_download(args):
+    export_metrics(args)
+
     pbar = fake_tqdm()
     pbar2 = fake_tqdm()
+    tarfp = None
+
+    if args.tar and (args.from_manifest or args.plan):
+        LOG.error("--tar can't be combined with --from-manifest or --plan")
+        return 1  # error
+
+    if args.link_root and not args.link:
+        LOG.error("--link-root requires --link")
+        return 1  # error
 
     try:
-        with init_clients(args) as (_, _, manifests):
-            fileindex = ManifestFileIndex(manifests)
+        with init_clients(args) as (_, cdn, manifests):
+            fileindex = ManifestFileIndex(manifests, case_sensitive=not args.ignore_case)
+            matched = fileindex.select(args.name, args.regex)
+
+            if args.tar:
+                tarfp = sys.stdout.buffer if args.tar == '-' else open(args.tar, 'wb')
+                downloader = TarStreamer(tarfp,
+                                         no_make_dirs=args.no_directories,
+                                         max_connections=args.max_connections,
+                                         max_memory=args.max_memory,
+                                         )
+            else:
+                downloader = DepotDownloader(args.output,
+                                             no_make_dirs=args.no_directories,
+                                             verify=(not args.skip_verify),
+                                             max_connections=args.max_connections,
+                                             order=args.order,
+                                             priorities=args.priority,
+                                             max_memory=args.max_memory,
+                                             link=args.link,
+                                             link_roots=args.link_root or (),
+                                             )
+
+            # delta update from the manifest that is currently installed
+            if args.from_manifest:
+                if not cdn or not args.depot or len(manifests) != 1:
+                    raise SteamError("--from-manifest requires --app and --depot")
+
+                LOG.info("Loading installed manifest (%s) ...", args.from_manifest)
+
+                old_manifest = cdn.get_manifest(
+                    args.app, args.depot, args.from_manifest,
+                    decrypt=(not args.skip_login or args.depot in cdn.depot_keys),
+                    manifest_request_code=cdn.get_manifest_request_code(args.app, args.depot, args.from_manifest),
+                )
 
-            # pre-index vpk file to speed up lookups
-            if args.vpk:
-                fileindex.index('*.vpk')
+                if old_manifest.filenames_encrypted:
+                    raise SteamError("Installed manifest filenames are encrypted. Steam login required.")
 
-            # calculate total size
-            total_files = 0
-            total_size = 0
+                downloader.add_delta_source(old_manifest)
 
             LOG.info("Locating and counting files...")
 
             for manifest in manifests:
+                LOG.info("Processing manifest (%s) '%s' ..." % (manifest.gid, manifest.name or "<Unknown>"))
+
                 for depotfile in manifest:
                     if not depotfile.is_file:
                         continue
@@ -435,11 +631,11 @@ def cmd_depot_download(args):
                         # fast skip VPKs that can't possibly match
                         if args.name and ':' in args.name:
                             pre = args.name.split(':', 1)[0]
-                            if not fnmatch(filepath, pre):
+                            if not fileindex.match(filepath, name=pre):
                                 continue
                         if args.regex and ':' in args.regex:
                             pre = args.regex.split(':', 1)[0]
-                            if not re_search(pre + '$', filepath):
+                            if not fileindex.match(filepath, regex=pre + '$'):
                                 continue
 
                         # scan VPKs, but skip data only ones
@@ -451,132 +647,87 @@ def cmd_depot_download(args):
                             except ValueError as exp:
                                 LOG.error("VPK read error: %s", str(exp))
                             else:
-                                for vpkfile_path, (_, _, _, _, _, size) in fvpk.c_iter_index():
+                                for vpkfile_path, metadata in fvpk.c_iter_index():
                                     complete_path = "{}:{}".format(filepath, vpkfile_path)
 
-                                    if args.name and not fnmatch(complete_path, args.name):
-                                        continue
-                                    if args.regex and not re_search(args.regex, complete_path):
+                                    if not fileindex.match(complete_path, args.name, args.regex):
                                         continue
 
-                                    total_files += 1
-                                    total_size += size
+                                    downloader.queue_vpkfile(depotfile.filename, fvpk, vpkfile_path, metadata)
 
                     # account for depot files
-                    if args.name and not fnmatch(filepath, args.name):
-                        continue
-                    if args.regex and not re_search(args.regex, filepath):
+                    if matched is not None and filepath not in matched:
                         continue
 
-                    total_files += 1
-                    total_size += depotfile.size
+                    downloader.queue_file(depotfile)
 
-            if not total_files:
+            if args.plan:
+                json.dump(downloader.plan(), sys.stdout, indent=4, sort_keys=True)
+                print()
+                return
+
+            if not downloader.total_files:
+                if downloader.files_unchanged:
+                    LOG.info("All %s files are up to date", downloader.files_unchanged)
+                    return
                 raise SteamError("No files found to download")
 
             # enable progress bar
             if not args.no_progress and sys.stderr.isatty():
-                pbar = tqdm(desc='Data ', mininterval=0.5, maxinterval=1, miniters=1024**3*10, total=total_size, unit='B', unit_scale=True)
-                pbar2 = tqdm(desc='Files', mininterval=0.5, maxinterval=1, miniters=10, total=total_files, position=1, unit=' file', unit_scale=False)
+                pbar = tqdm(desc='Data ', mininterval=0.5, maxinterval=1, miniters=1024**3*10, total=downloader.total_size, unit='B', unit_scale=True)
+                pbar2 = tqdm(desc='Files', mininterval=0.5, maxinterval=1, miniters=10, total=downloader.total_files, position=1, unit=' file', unit_scale=False)
                 gevent.spawn(pbar.gevent_refresh_loop)
                 gevent.spawn(pbar2.gevent_refresh_loop)
 
-            # download files
-            tasks = GPool(6)
-
-            for manifest in manifests:
-                if pbar2.n == total_files:
-                    break
-
-                LOG.info("Processing manifest (%s) '%s' ..." % (manifest.gid, manifest.name or "<Unknown>"))
-
-                for depotfile in manifest:
-                    if pbar2.n == total_files:
-                        break
-
-                    if not depotfile.is_file:
-                        continue
-
-                    filepath = depotfile.filename_raw
-
-                    if args.vpk and filepath.endswith('.vpk'):
-                        # fast skip VPKs that can't possibly match
-                        if args.name and ':' in args.name:
-                            pre = args.name.split(':', 1)[0]
-                            if not fnmatch(filepath, pre):
-                                continue
-                        if args.regex and ':' in args.regex:
-                            pre = args.regex.split(':', 1)[0]
-                            if not re_search(pre + '$', filepath):
-                                continue
-
-                        # scan VPKs, but skip data only ones
-                        if filepath.endswith('_dir.vpk') or not re.search("_\d+\.vpk$", filepath):
-                            LOG.debug("Scanning VPK file: %s", filepath)
-
-                            try:
-                                fvpk = fileindex.get_vpk(filepath)
-                            except ValueError as exp:
-                                LOG.error("VPK read error: %s", str(exp))
-                            else:
-                                for vpkfile_path, metadata in fvpk.c_iter_index():
-                                    complete_path = "{}:{}".format(filepath, vpkfile_path)
-
-                                    if args.name and not fnmatch(complete_path, args.name):
-                                        continue
-                                    if args.regex and not re_search(args.regex, complete_path):
-                                        continue
-
-                                    tasks.spawn(vpkfile_download_to,
-                                                depotfile.filename,
-                                                fvpk.get_vpkfile_instance(vpkfile_path,
-                                                                          fvpk._make_meta_dict(metadata)),
-                                                args.output,
-                                                no_make_dirs=args.no_directories,
-                                                pbar=pbar,
-                                                )
-
-                                    pbar2.update(1)
-
-                                    # break out of vpk file loop
-                                    if pbar2.n == total_files:
-                                        break
-
-                    # break out of depotfile loop
-                    if pbar2.n == total_files:
-                        break
+            downloader.pbar = pbar
+            downloader.pbar_files = pbar2
 
-                    # filepath filtering
-                    if args.name and not fnmatch(filepath, args.name):
-                        continue
-                    if args.regex and not re_search(args.regex, filepath):
-                        continue
+            # download files
+            downloader.run()
+            gevent.sleep(0.5)
 
-                    tasks.spawn(depotfile.download_to, args.output,
-                                no_make_dirs=args.no_directories,
-                                pbar=pbar,
-                                verify=(not args.skip_verify),
-                                )
+            LOG.info("Settled on %s concurrent connections", downloader.connections.limit)
+            LOG.debug("Peak chunk data in memory: %s", fmt_size(downloader.memory.peak))
 
-                    pbar2.update(1)
+            if downloader.files_linked:
+                LOG.info("Linked %s files (%s) to identical files", downloader.files_linked, fmt_size(downloader.bytes_linked))
 
-            # wait on all downloads to finish
-            tasks.join()
-            gevent.sleep(0.5)
+            if args.from_manifest:
+                LOG.info("Delta update saved %s (%s unchanged files, %s reused chunk data)",
+                         fmt_size(downloader.bytes_unchanged + downloader.bytes_reused),
+                         downloader.files_unchanged,
+                         fmt_size(downloader.bytes_reused),
+                         )
+            else:
+                if downloader.files_unchanged:
+                    LOG.info("Skipped %s files unchanged since last verified", downloader.files_unchanged)
+                if downloader.bytes_reused:
+                    LOG.info("Reused %s of chunks already on disk", fmt_size(downloader.bytes_reused))
+
+            if downloader.failed:
+                downloader.report_failed()
+                raise SteamError("Failed to download {} file(s)".format(len(downloader.failed)))
     except KeyboardInterrupt:
         pbar.close()
         LOG.info("Download canceled")
         return 1  # error
     except SteamError as exp:
         pbar.close()
-        pbar.write(str(exp))
+        if args.tar == '-':
+            LOG.error(str(exp))  # stdout has the archive
+        else:
+            pbar.write(str(exp))
         return 1  # error
     else:
         pbar.close()
         if not args.no_progress:
             pbar2.close()
-            pbar2.write('\n')
+            if args.tar != '-':
+                pbar2.write('\n')
         LOG.info('Download complete')
+    finally:
+        if tarfp and tarfp is not sys.stdout.buffer:
+            tarfp.close()
 
 from hashlib import sha1
 
@@ -594,55 +745,78 @@ def cmd_depot_diff(args):
         with init_clients(args) as (_, _, manifests):
             targetdir = args.TARGETDIR
             fileindex = {}
+            state = InstallState(targetdir)
+            recording = True
+
+            try:
+                for manifest in manifests:
+                    LOG.debug("Scanning manifest: %r", manifest)
+                    for mfile in manifest.iter_files():
+                        if not mfile.is_file:
+                            continue
 
-            for manifest in manifests:
-                LOG.debug("Scanning manifest: %r", manifest)
-                for mfile in manifest.iter_files():
-                    if not mfile.is_file:
-                        continue
-
-                    if args.name and not fnmatch(mfile.filename_raw, args.name):
-                        continue
-                    if args.regex and not re_search(args.regex, mfile.filename_raw):
-                        continue
-
-                    if args.show_extra:
-                        fileindex[mfile.filename] = mfile.file_mapping
-
-                    if args.hide_missing and args.hide_mismatch:
-                        continue
-
-                    full_filepath = os.path.join(targetdir, mfile.filename)
-                    if os.path.isfile(full_filepath):
-                        # do mismatch, checksum checking
-                        size = os.path.getsize(full_filepath)
-
-                        if size != mfile.size:
-                            print("Mismatch (size):", full_filepath)
+                        if args.name and not fnmatch(mfile.filename_raw, args.name):
+                            continue
+                        if args.regex and not re_search(args.regex, mfile.filename_raw):
                             continue
 
-                        # valve sets the checksum for empty files to all nulls
-                        if size == 0:
-                            chucksum = b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-                        else:
-                            chucksum = calc_sha1_for_file(full_filepath)
+                        if args.show_extra:
+                            fileindex[mfile.filename] = mfile.file_mapping
 
-                        if chucksum != mfile.file_mapping.sha_content:
-                            print("Mismatch (checksum):", full_filepath)
+                        if args.hide_missing and args.hide_mismatch:
+                            continue
 
-                    elif not args.hide_missing:
-                        print("Missing file:", full_filepath)
+                        full_filepath = os.path.join(targetdir, mfile.filename)
+                        if os.path.isfile(full_filepath):
+                            # do mismatch, checksum checking
+                            size = os.path.getsize(full_filepath)
 
+                            if size != mfile.size:
+                                print("Mismatch (size):", full_filepath)
+                                continue
 
-            # walk file system and show files not in manifest(s)
-            if args.show_extra:
-                for cdir, _, files in os.walk(targetdir):
-                    for filename in files:
-                        filepath = os.path.join(cdir, filename)
-                        rel_filepath = os.path.relpath(filepath, targetdir)
+                            # unchanged since it was last verified
+                            if state.is_verified(full_filepath, mfile.file_mapping):
+                                continue
 
-                        if rel_filepath.lower() not in fileindex:
-                            print("Not in manifest:", filepath)
+                            # valve sets the checksum for empty files to all nulls
+                            if size == 0:
+                                chucksum = b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+                            else:
+                                chucksum = calc_sha1_for_file(full_filepath)
+
+                            if chucksum != mfile.file_mapping.sha_content:
+                                print("Mismatch (checksum):", full_filepath)
+                            elif recording:
+                                # the target may be read-only, diffing works without recording
+                                try:
+                                    state.record(full_filepath, manifest.gid, mfile.file_mapping)
+                                except (sqlite3.Error, OSError) as exp:
+                                    LOG.debug("Not recording verified files in %s: %s", targetdir, exp)
+                                    recording = False
+
+                        elif not args.hide_missing:
+                            print("Missing file:", full_filepath)
+
+
+                # walk file system and show files not in manifest(s)
+                if args.show_extra:
+                    for cdir, dirs, files in os.walk(targetdir):
+                        # skip steamctl's own state
+                        if cdir == targetdir and STATE_DIR in dirs:
+                            dirs.remove(STATE_DIR)
+
+                        for filename in files:
+                            filepath = os.path.join(cdir, filename)
+                            rel_filepath = os.path.relpath(filepath, targetdir)
+
+                            if rel_filepath.lower() not in fileindex:
+                                print("Not in manifest:", filepath)
+            finally:
+                try:
+                    state.close()
+                except (sqlite3.Error, OSError) as exp:
+                    LOG.debug("Failed saving verified files in %s: %s", targetdir, exp)
 
     except KeyboardInterrupt:
         return 1  # error
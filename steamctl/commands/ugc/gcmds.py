@@ -7,7 +7,7 @@ gevent.monkey.patch_ssl()
 import os
 import sys
 import logging
-from io import open
+from urllib.parse import urlparse
 from contextlib import contextmanager
 from steam import webapi
 from steam.exceptions import SteamError
@@ -17,6 +17,9 @@ from steamctl.utils.storage import ensure_dir, sanitizerelpath
 from steamctl.utils.web import make_requests_session
 from steamctl.utils.format import fmt_size
 from steamctl.utils.tqdm import tqdm, fake_tqdm
+from steamctl.utils.ratelimit import make_rate_limiter
+from steamctl.utils.metrics import metrics, export_metrics
+from steamctl.utils.writer import WriteBehind
 from steamctl.commands.webapi import get_webapi_key
 
 webapi._make_requests_session = make_requests_session
@@ -58,6 +61,8 @@ def cmd_ugc_info(args):
 
 
 def cmd_ugc_download(args):
+    export_metrics(args)
+
     with init_client(args) as s:
         ugcdetails = s.get_ugc_details(args.ugc)
 
@@ -65,8 +70,10 @@ def cmd_ugc_download(args):
 
 
 def download_via_url(args, url, filename):
+    limiter = make_rate_limiter(args)
     sess = make_requests_session()
     fstream = sess.get(url, stream=True)
+    metrics.observe('steamctl_request_seconds', fstream.elapsed.total_seconds(), server=urlparse(url).hostname)
     total_size = int(fstream.headers.get('Content-Length', 0))
 
     relpath = sanitizerelpath(filename)
@@ -79,21 +86,33 @@ def download_via_url(args, url, filename):
     filepath = os.path.abspath(relpath)
     ensure_dir(filepath)
 
-    with open(filepath, 'wb') as fp:
-        if not args.no_progress and sys.stderr.isatty():
-            pbar = tqdm(total=total_size, mininterval=0.5, maxinterval=1, miniters=1024**3*10, unit='B', unit_scale=True)
-            gevent.spawn(pbar.gevent_refresh_loop)
-        else:
-            pbar = fake_tqdm()
+    if not args.no_progress and sys.stderr.isatty():
+        pbar = tqdm(total=total_size, mininterval=0.5, maxinterval=1, miniters=1024**3*10, unit='B', unit_scale=True)
+        gevent.spawn(pbar.gevent_refresh_loop)
+    else:
+        pbar = fake_tqdm()
+
+    writer = WriteBehind(threads=1)
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    offset = 0
 
+    try:
 #       LOG.info('Downloading to {} ({})'.format(
 #                   relpath,
 #                   fmt_size(total_size) if total_size else 'Unknown size',
 #                   ))
 
-        for chunk in iter(lambda: fstream.raw.read(8388608), b''):
-            fp.write(chunk)
+        for chunk in iter(lambda: fstream.raw.read(limiter.read_size(8388608)), b''):
+            writer.write(fd, chunk, offset)
+            offset += len(chunk)
+            metrics.inc('steamctl_fetched_bytes_total', len(chunk), source='http')
             pbar.update(len(chunk))
-
-        pbar.close()
+            limiter.consume(len(chunk))
+    finally:
+        try:
+            writer.close(fd)
+        finally:
+            writer.kill()
+
+    pbar.close()
 
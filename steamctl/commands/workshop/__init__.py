@@ -1,6 +1,7 @@
 
 from steamctl.argparser import register_command
 from steamctl.utils.storage import UserDataFile, UserCacheFile
+from steamctl.utils.format import parse_size, parse_rate, parse_schedule
 from argcomplete import warn
 
 
@@ -54,6 +55,12 @@ def cmd_parser(cp):
     scp_dl.add_argument('-o', '--output', type=str, default='', help='Path to directory for the downloaded files (default: cwd)')
     scp_dl.add_argument('-nd', '--no-directories', action='store_true', help='Do not create directories')
     scp_dl.add_argument('-np', '--no-progress', action='store_true', help='Do not create directories')
+    scp_dl.add_argument('--max-connections', type=int, default=32, help='Upper limit for concurrent connections, the actual number adapts to throughput (default: 32)')
+    scp_dl.add_argument('--max-memory', type=parse_size, default='1GB', help='Budget for chunk data held in memory, new chunk fetches wait when it is reached (default: 1GB, 0 for unlimited)')
+    scp_dl.add_argument('--limit-rate', type=parse_rate, default=0, metavar='RATE', help='Limit download rate in bytes per second, shared by all connections (e.g. 2MB, 500KiB)')
+    scp_dl.add_argument('--limit-schedule', type=parse_schedule, metavar='SCHEDULE', help='Download rate by time of day, e.g. 08:00-23:00=2MB,23:00-08:00=0 (0 is unlimited). Outside of it --limit-rate applies')
+    scp_dl.add_argument('--limit-file', type=str, metavar='PATH', help='File containing a download rate, overrides the other limits. Re-read when changed, or on SIGHUP')
+    scp_dl.add_argument('--metrics-file', type=str, metavar='PATH', help='Write transfer metrics to PATH, as JSON when it ends with .json, otherwise in Prometheus text format (updated every 15s, for the node_exporter textfile collector)')
     scp_dl.add_argument('id', type=int, help='Workshop item ID')
     scp_dl.set_defaults(_cmd_func=__name__ + '.gcmds:cmd_workshop_download')
 
@@ -4,12 +4,11 @@ gevent.monkey.patch_socket()
 gevent.monkey.patch_select()
 gevent.monkey.patch_ssl()
 
-from gevent.pool import Pool as GPool
-
 import os
 import sys
 import logging
 from io import open
+from contextlib import closing
 from steam import webapi
 from steam.exceptions import SteamError, ManifestError
 from steam.enums import EResult
@@ -17,14 +16,19 @@ from steamctl.utils.storage import ensure_dir, sanitizerelpath
 from steamctl.utils.web import make_requests_session
 from steamctl.utils.format import fmt_size
 from steamctl.utils.tqdm import tqdm, fake_tqdm
+from steamctl.utils.ratelimit import make_rate_limiter
+from steamctl.utils.metrics import export_metrics
 from steamctl.commands.webapi import get_webapi_key
 from steamctl.commands.ugc.gcmds import download_via_url
+from steamctl.downloader import DepotDownloader
 
 webapi._make_requests_session = make_requests_session
 
 LOG = logging.getLogger(__name__)
 
 def cmd_workshop_download(args):
+    export_metrics(args)
+
     apikey = args.apikey or get_webapi_key()
 
     if not apikey:
@@ -70,7 +74,7 @@ def download_via_steampipe(args, pubfile):
     s = CachingSteamClient()
     if args.cell_id is not None:
         s.cell_id = args.cell_id
-    cdn = s.get_cdnclient()
+    cdn = s.get_cdnclient(rate_limiter=make_rate_limiter(args))
 
 
     key = pubfile['consumer_appid'], pubfile['consumer_appid'], pubfile['hcontent_file']
@@ -111,21 +115,25 @@ def download_via_steampipe(args, pubfile):
     else:
         pbar = fake_tqdm()
 
-    tasks = GPool(4)
+    downloader = DepotDownloader(args.output,
+                                 no_make_dirs=args.no_directories,
+                                 max_connections=args.max_connections,
+                                 max_memory=args.max_memory,
+                                 )
+    downloader.pbar = pbar
 
     for mfile in manifest:
         if not mfile.is_file:
             continue
-        tasks.spawn(mfile.download_to, args.output,
-                    no_make_dirs=args.no_directories,
-                    pbar=pbar)
+        downloader.queue_file(mfile)
 
     # wait on all downloads to finish
-    tasks.join()
+    with cdn.closing(), closing(pbar):
+        downloader.run()
 
-    # clean and exit
-    pbar.close()
-    cdn.save_cache()
-    s.disconnect()
+    if downloader.failed:
+        downloader.report_failed()
+        return 1  # error
 
+    LOG.info("Settled on %s concurrent connections", downloader.connections.limit)
     LOG.info("Download complete.")
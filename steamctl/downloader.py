@@ -0,0 +1,1569 @@
+import gevent
+from gevent.event import Event, AsyncResult
+from gevent.pool import Pool as GPool
+from gevent.queue import Queue
+from gevent.threadpool import ThreadPool
+
+import os
+import sys
+import errno
+import shutil
+import struct
+import sqlite3
+import tarfile
+import logging
+from fnmatch import fnmatch
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not available on Windows
+from time import time
+from io import open
+from bisect import bisect_right
+from hashlib import sha1
+from collections import deque
+from steam.enums import EDepotFileFlag
+from steam.exceptions import SteamError
+from steamctl.utils.concurrency import AdaptiveConcurrency, MemoryBudget, apply_returning_errors
+from steamctl.utils.format import fmt_size
+from steamctl.utils.metrics import metrics
+from steamctl.utils.storage import ensure_dir, sanitizerelpath
+from steamctl.utils.tqdm import fake_tqdm
+from steamctl.utils.writer import WriteBehind, pwrite
+
+LOG = logging.getLogger(__name__)
+
+STATE_DIR = '.steamctl'  # located in the output directory
+FICLONE = 0x40049409     # linux ioctl for reflinks
+
+
+def read_file_range(path, offset, length):
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        return fp.read(length)
+
+def hash_file_range(path, offset, length):
+    """SHA-1 digest for a range of a file. Safe to run in a thread, as hashlib releases the GIL"""
+    return sha1(read_file_range(path, offset, length)).digest()
+
+def fsync_path(path):
+    """Flush a file, or directory entries, to disk.
+    Meant for a thread pool, so errors are returned.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as exp:
+        return exp
+
+def write_ranges(ranges, create=False):
+    """Write ``(path, offset, data)`` ranges into files. With ``create``, files are
+    truncated to ``data`` first, and ``offset`` is the final file size instead.
+    Meant for a thread pool, so errors are returned as ``{path: exception}``.
+    """
+    errors = {}
+    flags = os.O_WRONLY | getattr(os, 'O_BINARY', 0) | (os.O_CREAT | os.O_TRUNC if create else 0)
+
+    for path, offset, data in ranges:
+        start = time()
+
+        try:
+            fd = os.open(path, flags, 0o644)
+
+            try:
+                if create:
+                    pwrite(fd, data, 0)
+                    os.ftruncate(fd, offset)
+                else:
+                    pwrite(fd, data, offset)
+            finally:
+                os.close(fd)
+        except Exception as exp:
+            errors.setdefault(path, exp)
+        else:
+            metrics.observe('steamctl_disk_write_seconds', time() - start)
+            metrics.inc('steamctl_written_bytes_total', len(data))
+
+    return errors
+
+def reflink(source, dest):
+    """Create ``dest`` as a copy-on-write clone of ``source``
+
+    :raises OSError: when the platform or filesystem doesn't support it
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def link_file(source, dest, method='auto'):
+    """Make ``dest`` have the content of ``source`` without copying data, if possible
+
+    :param method: ``reflink``, ``hardlink``, or ``auto`` to try reflink, then hardlink
+    :returns: method used, ``reflink``, ``hardlink`` or ``copy``
+    :rtype: str
+    """
+    if os.path.exists(dest) and os.path.samefile(source, dest):
+        return 'hardlink'
+
+    tmp = dest + '.steamctl_link'
+
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    try:
+        if method in ('reflink', 'auto'):
+            try:
+                reflink(source, tmp)
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                if method == 'reflink':
+                    raise
+            else:
+                os.replace(tmp, dest)
+                return 'reflink'
+
+        try:
+            os.link(source, tmp)
+        except OSError as exp:
+            # e.g. different filesystems, fall back to a plain copy
+            LOG.debug("Failed to hardlink %s: %s", source, exp)
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, dest)
+            return 'copy'
+        else:
+            os.replace(tmp, dest)
+            return 'hardlink'
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def preallocate(fd, size):
+    """Set the size of a file, and reserve disk space for it where supported"""
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass  # not supported by the filesystem, the file is sparse instead
+
+
+class DownloadJournal(object):
+    """Append-only record of completed chunks for a single manifest
+
+    Allows an interrupted download to resume, without having to re-read
+    and verify data that was already written. Records refer to files and
+    chunks by their position in the manifest, which is fixed for a manifest GID.
+    """
+    _record = struct.Struct('<II')  # file index, chunk index
+
+    def __init__(self, path, manifest, reset=False):
+        self.path = path
+        self.completed = {}  # file index -> set of completed chunk indexes
+        self.incomplete = False
+        self._file_index = {mapping.filename: i for i, mapping in enumerate(manifest.payload.mappings)}
+        self._fp = None
+        self._reset = reset  # overwrite, instead of append to, existing journal
+
+        if not reset and os.path.exists(path):
+            with open(path, 'rb') as fp:
+                data = fp.read()
+
+            # ignore partially written record at the end
+            data = data[:len(data) - len(data) % self._record.size]
+
+            for file_index, chunk_index in self._record.iter_unpack(data):
+                self.completed.setdefault(file_index, set()).add(chunk_index)
+
+            LOG.debug("Loaded journal %s (%s files)", path, len(self.completed))
+
+    def __repr__(self):
+        return "%s(%r)" % (
+            self.__class__.__name__,
+            self.path,
+            )
+
+    def file_index(self, depotfile):
+        return self._file_index[depotfile.file_mapping.filename]
+
+    def get_completed(self, file_index):
+        return self.completed.get(file_index, set())
+
+    def discard(self, file_index):
+        self.completed.pop(file_index, None)
+
+    def record(self, file_index, chunk_index):
+        if self._fp is None:
+            ensure_dir(self.path)
+            self._fp = open(self.path, 'wb' if self._reset else 'ab')
+
+        self._fp.write(self._record.pack(file_index, chunk_index))
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def remove(self):
+        self.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class InstallState(object):
+    """Records files in an install directory that were verified against a manifest
+
+    For every file, the manifest GID, size, mtime, inode and SHA-1 are recorded.
+    As long as a stat of the file still matches, it doesn't need to be hashed
+    again. Files modified around the time they were recorded are not trusted,
+    as a later change within the mtime resolution would go unnoticed.
+    The database is located in ``target``, and is only created when recording.
+
+    :param target: install directory
+    :type  target: str
+    """
+    racy_window = 2 * 10**9  #: nanoseconds, covers filesystems with 2 second mtime resolution
+
+    def __init__(self, target):
+        self.target = os.path.abspath(target)
+        self.path = os.path.join(self.target, STATE_DIR, 'state.sqlite3')
+        self._db = None
+
+    def __repr__(self):
+        return "%s(%r)" % (
+            self.__class__.__name__,
+            self.path,
+            )
+
+    def _connect(self, create=False):
+        if self._db is None and (create or os.path.exists(self.path)):
+            ensure_dir(self.path)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, gid TEXT,'
+                             ' size INTEGER, mtime_ns INTEGER, inode INTEGER, sha BLOB, recorded_ns INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_sha ON files (sha)')
+        return self._db
+
+    def _key(self, filepath):
+        return os.path.relpath(os.path.abspath(filepath), self.target)
+
+    def is_verified(self, filepath, file_mapping):
+        """Check whether ``filepath`` has the content of ``file_mapping``, based on stat alone"""
+        if not self._connect():
+            return False
+
+        row = self._db.execute('SELECT size, mtime_ns, inode, sha, recorded_ns FROM files WHERE path = ?',
+                               (self._key(filepath),)).fetchone()
+
+        return bool(row) and self._matches(filepath, file_mapping, *row)
+
+    def _matches(self, filepath, file_mapping, size, mtime_ns, inode, sha, recorded_ns):
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return False
+
+        return (sha == file_mapping.sha_content
+                and size == file_mapping.size == st.st_size
+                and mtime_ns == st.st_mtime_ns
+                and inode == st.st_ino
+                and mtime_ns < recorded_ns - self.racy_window
+                )
+
+    def find(self, file_mapping):
+        """Find a file with the content of ``file_mapping``, based on stat alone
+
+        :returns: path to the file, or ``None``
+        :rtype: str
+        """
+        if not self._connect():
+            return
+
+        rows = self._db.execute('SELECT path, size, mtime_ns, inode, sha, recorded_ns FROM files WHERE sha = ?',
+                                (file_mapping.sha_content,))
+
+        for relpath, row in ((row[0], row[1:]) for row in rows):
+            filepath = os.path.join(self.target, relpath)
+
+            if self._matches(filepath, file_mapping, *row):
+                return filepath
+
+    def record(self, filepath, gid, file_mapping):
+        """Record that ``filepath`` currently has the content of ``file_mapping``"""
+        st = os.stat(filepath)
+        self._connect(create=True).execute('REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                           (self._key(filepath), str(gid), st.st_size, st.st_mtime_ns,
+                                            st.st_ino, file_mapping.sha_content, int(time() * 10**9)))
+
+    def forget(self, filepath):
+        if self._connect():
+            self._db.execute('DELETE FROM files WHERE path = ?', (self._key(filepath),))
+
+    def commit(self):
+        if self._db is not None:
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+
+class DepotFileJob(object):
+    """Tracks the chunks of a single depot file while they are being downloaded"""
+    def __init__(self, depotfile, filepath, writer, verify=True, writepath=None, journal=None):
+        self.depotfile = depotfile
+        self.writer = writer
+        self.filepath = filepath
+        self.writepath = writepath or filepath  # staging path, renamed to filepath once complete
+        self.verify = verify and os.path.exists(self.writepath)
+        self.chunks = deque(enumerate(depotfile.chunks))  # (index, chunk) not yet handed to a worker
+        self.pending = len(self.chunks)                   # chunks not yet completed
+        self.failed_chunks = 0                            # chunks that could not be fetched
+        self.size_checked = False                         # existing file was checked to have the right size
+        self.journal = journal
+        self.file_index = journal.file_index(depotfile) if journal else None
+        self.priority = 0
+        self.done = False
+        self.error = None
+        self._fd = None
+        self._opening = None  # AsyncResult for the fd, while or once opened
+
+    def __repr__(self):
+        return "<%s(%r, pending=%s)>" % (
+            self.__class__.__name__,
+            self.filepath,
+            self.pending,
+            )
+
+    @property
+    def size(self):
+        return self.depotfile.size
+
+    def open(self, threadpool=None):
+        """Open the file for positional writes, returns a file descriptor.
+        The parent directory must already exist
+
+        :param threadpool: pool to open and preallocate in, as preallocating can write
+                           the whole file on filesystems without ``fallocate``
+        :type  threadpool: :class:`gevent.threadpool.ThreadPool`
+        """
+        opening = self._opening
+
+        if opening is None:
+            opening = self._opening = AsyncResult()
+            fd, exp = apply_returning_errors(threadpool, self._open)
+
+            if exp is not None:
+                self._opening = None
+                opening.set_exception(exp)
+            else:
+                self._fd = fd
+                opening.set(fd)
+
+        return opening.get()
+
+    def _open(self):
+        fd = os.open(self.writepath, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+
+        try:
+            preallocate(fd, self.size)
+        except OSError as exp:
+            os.close(fd)
+            raise SteamError("Failed allocating space for {}: {}".format(self.writepath, exp))
+
+        return fd
+
+    def write(self, data, offset, callback=None):
+        self.writer.write(self.open(), data, offset, callback)
+
+    def close(self):
+        """Wait for queued writes and close the file, raises write errors"""
+        try:
+            if self._fd is not None:
+                fd, self._fd, self._opening = self._fd, None, None
+                self.writer.close(fd)
+        finally:
+            if self.journal:
+                self.journal.flush()
+
+
+class VPKFileJob(object):
+    """A single file from inside a VPK, extracted via the depot file index"""
+    def __init__(self, fvpk, vpkfile_path, metadata, filepath):
+        self.fvpk = fvpk
+        self.vpkfile_path = vpkfile_path
+        self.metadata = metadata
+        self.filepath = filepath
+        self.priority = 0
+        self.pending = 0  # archive chunks not yet written
+        self.error = None
+
+    def __repr__(self):
+        return "<%s(%r)>" % (
+            self.__class__.__name__,
+            self.filepath,
+            )
+
+    @property
+    def size(self):
+        return self.metadata[2] + self.metadata[5]  # preload and archive data
+
+    @property
+    def archive_path(self):
+        """Depot path of the archive holding the entry data"""
+        return self.fvpk._make_vpkfile_path(self.fvpk._make_meta_dict(self.metadata))
+
+
+class VPKArchiveJob(object):
+    """VPK entries stored in the same archive, extracted together so that each
+    archive chunk they cover is fetched once
+
+    Items in :attr:`chunks` are ``(chunk, pieces)``, where each piece is
+    ``(entry, start, end, offset)``: the range of the chunk data that goes
+    at ``offset`` in the entry's file.
+    """
+    def __init__(self, archive, entries):
+        self.archive = archive
+        self.entries = entries
+        self.priority = min(entry.priority for entry in entries)
+        self.error = None
+
+        chunks = sorted(archive.chunks, key=lambda chunk: chunk.offset)
+        offsets = [chunk.offset for chunk in chunks]
+        pieces = {}  # chunk index -> pieces
+
+        for entry in entries:
+            preload_length, archive_offset, file_length = entry.metadata[2], entry.metadata[4], entry.metadata[5]
+            start, end = archive_offset, archive_offset + file_length
+            index = bisect_right(offsets, start) - 1
+            entry.pending = 0
+
+            while start < end and 0 <= index < len(chunks):
+                chunk = chunks[index]
+                piece_end = min(end, chunk.offset + chunk.cb_original)
+                pieces.setdefault(index, []).append((entry,
+                                                     start - chunk.offset,
+                                                     piece_end - chunk.offset,
+                                                     preload_length + start - archive_offset,
+                                                     ))
+                entry.pending += 1
+                start = piece_end
+                index += 1
+
+            if start < end:
+                entry.error = SteamError("Data is outside of {}".format(archive.filename))
+
+        self.chunks = deque((chunks[index], pieces[index]) for index in sorted(pieces))
+        self.pending = len(self.chunks)
+
+    def __repr__(self):
+        return "<%s(%r, entries=%r, chunks=%r)>" % (
+            self.__class__.__name__,
+            self.archive.filename,
+            len(self.entries),
+            len(self.chunks),
+            )
+
+    @property
+    def size(self):
+        return sum(entry.size for entry in self.entries)
+
+
+class LinkFileJob(object):
+    """A depot file that is linked to a file with identical content, instead of downloaded
+
+    The source is either a path to an existing file, or a :class:`DepotFileJob`
+    that has to complete first.
+    """
+    def __init__(self, depotfile, filepath, source):
+        self.depotfile = depotfile
+        self.filepath = filepath
+        self.source = source
+        self.priority = 0
+        self.error = None
+
+    def __repr__(self):
+        return "<%s(%r)>" % (
+            self.__class__.__name__,
+            self.filepath,
+            )
+
+    @property
+    def size(self):
+        return self.depotfile.size
+
+    @property
+    def source_path(self):
+        if isinstance(self.source, DepotFileJob):
+            return self.source.filepath
+        return self.source
+
+
+class DepotDownloader(object):
+    """Downloads depot files by scheduling individual chunks across a shared set of workers
+
+    Every queued file is flattened into chunk work items, so all workers stay busy
+    regardless of how file sizes are distributed. Files are counted as done once
+    their last chunk has been written. The number of concurrent CDN requests adapts
+    to measured throughput, see :class:`.AdaptiveConcurrency`.
+
+    The directory tree is created once, before any downloads start. Files are
+    preallocated, and chunks are written at their offsets with ``pwrite``,
+    so chunks of a file can complete in any order. Writes happen in a thread pool,
+    see :class:`.WriteBehind`, and are only recorded in the journal once done.
+
+    Chunks are only fetched from the CDN once per run. Once a chunk is on disk,
+    any other occurrence of it is copied from there instead.
+
+    Chunks of existing files are verified in a thread pool, in parallel with the
+    network workers. Only chunks that fail verification are passed on to be downloaded.
+
+    Completed chunks are recorded in a journal per manifest, inside ``target``.
+    When ``verify`` is enabled, an interrupted download resumes from the journal,
+    and only chunks not recorded in it are verified or downloaded.
+
+    Verified and downloaded files are recorded in :class:`InstallState`. On later runs,
+    files that still match by size, mtime and inode are skipped without hashing.
+
+    For delta updates, see :meth:`add_delta_source`.
+
+    With ``link``, files with identical content are only written once, and then
+    reflinked or hardlinked, see :func:`link_file`. Sources can also be files
+    recorded in the install state of other ``link_roots``. Files that are
+    hardlinked are never modified in place, updates replace them instead.
+
+    Files are downloaded in phases, one per priority class, in the given ``order``
+    within each phase. Files matching a priority class are fully written, renamed
+    into place and fsynced before the next phase starts.
+
+    :param target: output directory
+    :type  target: str
+    :param no_make_dirs: place all files directly in ``target``
+    :type  no_make_dirs: bool
+    :param verify: verify existing files and only download chunks that differ
+    :type  verify: bool
+    :param max_connections: upper limit for concurrent CDN requests
+    :type  max_connections: int
+    :param verify_threads: number of threads for verifying chunks (default: cpu count)
+    :type  verify_threads: int
+    :param order: ``manifest``, ``smallest``, ``largest`` or ``directory``
+    :type  order: str
+    :param priorities: list of priority classes, each a list of globs matched against paths relative to ``target``
+    :type  priorities: list
+    :param max_memory: budget in bytes for chunk data held in memory, until it is written (``0`` for unlimited)
+    :type  max_memory: int
+    :param link: ``None``, ``reflink``, ``hardlink`` or ``auto``
+    :type  link: str
+    :param link_roots: other install directories to link files from
+    :type  link_roots: list
+    """
+    orders = {
+        'manifest': None,
+        'smallest': lambda job: job.size,
+        'largest': lambda job: -job.size,
+        'directory': lambda job: os.path.split(job.filepath),
+    }
+
+    def __init__(self, target, no_make_dirs=False, verify=True, max_connections=32, verify_threads=None,
+                 order='manifest', priorities=None, max_memory=0, link=None, link_roots=()):
+        if order not in self.orders:
+            raise ValueError("Invalid order: %r" % order)
+
+        self.target = target
+        self.no_make_dirs = no_make_dirs
+        self.verify = verify
+        self.order = order
+        self.priorities = priorities or []
+        self.memory = MemoryBudget(max_memory)
+        self.link = link
+        self.link_roots = [InstallState(root) for root in link_roots]
+        self.files_linked = 0
+        self.bytes_linked = 0
+        self.connections = AdaptiveConcurrency(initial=6, maximum=max_connections)
+        self.verify_threads = verify_threads or os.cpu_count() or 1
+        self.pbar = fake_tqdm()
+        self.pbar_files = fake_tqdm()
+        self.total_files = 0
+        self.total_size = 0
+        self.failed = []
+        self.failed_chunks = []  # (job, chunk, exception) for chunks that could not be fetched
+        self.bytes_downloaded = 0
+        self.bytes_reused = 0
+        self.files_unchanged = 0
+        self.bytes_unchanged = 0
+        self.bytes_resumed = 0
+        self._queue = deque()
+        self._verify_queue = deque()
+        self._fetch_items = deque()  # chunks that failed verification
+        self._fetch_event = Event()
+        self._verifying = 0
+        self._chunk_locations = {}  # chunk sha -> (filepath, offset) of a copy on disk
+        self._delta_files = {}      # filepath -> file mapping from the installed manifest
+        self._staged = []
+        self._journals = {}
+        self._dirs = set()
+        self._writer = WriteBehind()
+        self._completed = []
+        self.state = InstallState(target)
+        self._links = []
+        self._content_jobs = {}  # sha_content -> first job writing that content
+
+    def _make_filepath(self, relpath, prefix=''):
+        relpath = sanitizerelpath(relpath)
+
+        if self.no_make_dirs:
+            relpath = os.path.basename(relpath)
+        else:
+            relpath = os.path.join(prefix, relpath)
+
+        return os.path.abspath(os.path.join(self.target, relpath))
+
+    def add_delta_source(self, manifest):
+        """Use files installed in ``target`` from an older manifest as a source of chunks
+
+        Must be called before queuing files. Files identical in both manifests are skipped,
+        without reading them. Changed files are written to a staging path and only renamed
+        into place once the whole download completes, so that their old content can be
+        used as a chunk source until then. Chunks copied from old files are still
+        verified against their SHA-1.
+
+        :param manifest: manifest that is currently installed
+        :type  manifest: :class:`.CTLDepotManifest`
+        """
+        for depotfile in manifest:
+            if not depotfile.is_file:
+                continue
+
+            filepath = self._make_filepath(depotfile.filename)
+            self._delta_files[filepath] = depotfile.file_mapping
+
+            if not os.path.isfile(filepath) or os.path.getsize(filepath) != depotfile.size:
+                continue
+
+            for chunk in depotfile.chunks:
+                self._chunk_locations.setdefault(chunk.sha, (filepath, chunk.offset))
+
+    def _get_priority(self, filepath):
+        relpath = os.path.relpath(filepath, os.path.abspath(self.target)).replace(os.sep, '/')
+
+        for priority, globs in enumerate(self.priorities):
+            if any(fnmatch(relpath, glob) for glob in globs):
+                return priority
+
+        return len(self.priorities)
+
+    def _get_journal(self, manifest):
+        key = manifest.depot_id, manifest.gid
+
+        if key not in self._journals:
+            path = os.path.join(self.target, STATE_DIR, 'journal_{}_{}'.format(*key))
+
+            # without verify, everything is downloaded again
+            self._journals[key] = DownloadJournal(path, manifest, reset=not self.verify)
+
+        return self._journals[key]
+
+    def _resume_job(self, job):
+        completed = job.journal.get_completed(job.file_index)
+
+        if not completed:
+            return
+
+        # the journal is only valid for the file it was written for
+        if not os.path.isfile(job.writepath) or os.path.getsize(job.writepath) != job.size:
+            job.journal.discard(job.file_index)
+            return
+
+        remaining = deque()
+
+        for chunk_index, chunk in job.chunks:
+            if chunk_index in completed:
+                self._chunk_locations.setdefault(chunk.sha, (job.writepath, chunk.offset))
+                self.bytes_resumed += chunk.cb_original
+            else:
+                remaining.append((chunk_index, chunk))
+
+        job.chunks = remaining
+        job.pending = len(remaining)
+        job.verify = False  # chunks not in the journal have not been written yet
+
+    def queue_file(self, depotfile):
+        filepath = self._make_filepath(depotfile.filename)
+        old_mapping = self._delta_files.get(filepath)
+        journal = self._get_journal(depotfile.manifest)
+
+        if self.verify and self.state.is_verified(filepath, depotfile.file_mapping):
+            for chunk in depotfile.chunks:
+                self._chunk_locations.setdefault(chunk.sha, (filepath, chunk.offset))
+
+            self.files_unchanged += 1
+            self.bytes_unchanged += depotfile.size
+            return
+
+        if self.link and depotfile.size:
+            source = (self._content_jobs.get(depotfile.file_mapping.sha_content)
+                      or self._find_link_source(depotfile))
+
+            if source is not None:
+                job = LinkFileJob(depotfile, filepath, source)
+                job.priority = self._get_priority(filepath)
+                self._links.append(job)
+                self._dirs.add(os.path.dirname(filepath))
+                self.total_files += 1
+                return job
+
+        if old_mapping is None:
+            # hardlinked files are shared, so they are replaced instead of modified
+            if os.path.isfile(filepath) and os.stat(filepath).st_nlink > 1:
+                job = DepotFileJob(depotfile, filepath, self._writer,
+                                   verify=False, writepath=filepath + '.steamctl_delta', journal=journal)
+                self._staged.append(job)
+
+                # the current content is a chunk source, chunks read from it are verified
+                if os.path.getsize(filepath) == depotfile.size:
+                    for chunk in depotfile.chunks:
+                        self._chunk_locations.setdefault(chunk.sha, (filepath, chunk.offset))
+            else:
+                job = DepotFileJob(depotfile, filepath, self._writer, verify=self.verify, journal=journal)
+        elif (old_mapping.sha_content == depotfile.file_mapping.sha_content
+              and old_mapping.size == depotfile.size
+              and os.path.isfile(filepath)
+              and os.path.getsize(filepath) == depotfile.size):
+            self.files_unchanged += 1
+            self.bytes_unchanged += depotfile.size
+            return
+        else:
+            job = DepotFileJob(depotfile, filepath, self._writer,
+                               verify=False, writepath=filepath + '.steamctl_delta', journal=journal)
+            self._staged.append(job)
+
+        if self.verify:
+            self._resume_job(job)
+
+        job.priority = self._get_priority(filepath)
+
+        if self.link and depotfile.size:
+            self._content_jobs.setdefault(depotfile.file_mapping.sha_content, job)
+
+        if job.verify:
+            self._verify_queue.append(job)
+        else:
+            self._queue.append(job)
+
+        self._dirs.add(os.path.dirname(job.writepath))
+        self.total_files += 1
+        self.total_size += job.size
+        return job
+
+    def _find_link_source(self, depotfile):
+        for state in self.link_roots:
+            source = state.find(depotfile.file_mapping)
+
+            if source:
+                return source
+
+    def queue_vpkfile(self, vpk_path, fvpk, vpkfile_path, metadata):
+        job = VPKFileJob(fvpk, vpkfile_path, metadata,
+                         self._make_filepath(vpkfile_path, prefix=vpk_path[:-4]),  # e.g. pak01_dir
+                         )
+        job.priority = self._get_priority(job.filepath)
+        self._queue.append(job)
+        self._dirs.add(os.path.dirname(job.filepath))
+        self.total_files += 1
+        self.total_size += job.size
+        return job
+
+    def _make_dirs(self):
+        # skip directories that are parents of ones already made
+        made = set()
+
+        for dirpath in sorted(self._dirs, key=len, reverse=True):
+            if dirpath not in made:
+                os.makedirs(dirpath, 0o750, exist_ok=True)
+
+                while dirpath not in made and os.path.dirname(dirpath) != dirpath:
+                    made.add(dirpath)
+                    dirpath = os.path.dirname(dirpath)
+
+        self._dirs.clear()
+
+    def _next_item(self, queue):
+        while queue:
+            job = queue[0]
+
+            if not isinstance(job, (DepotFileJob, VPKArchiveJob)):
+                return queue.popleft(), None
+
+            # empty files have no chunks, but still need to be created
+            if job.pending == 0:
+                queue.popleft()
+                return job, None
+
+            if job.error or not job.chunks:
+                queue.popleft()
+                continue
+
+            item = job.chunks.popleft()
+
+            if not job.chunks:
+                queue.popleft()
+
+            return job, item
+
+        return None, None
+
+    def _verify_worker(self):
+        try:
+            while True:
+                job, item = self._next_item(self._verify_queue)
+
+                if job is None:
+                    return
+
+                if item is None:
+                    self._download_empty_file(job)
+                else:
+                    self._verify_chunk(job, *item)
+        finally:
+            self._verifying -= 1
+            self._fetch_event.set()
+
+    def _verify_chunk(self, job, chunk_index, chunk):
+        # opening sets the file size, files are otherwise only opened when a chunk is fetched
+        if not job.size_checked:
+            job.size_checked = True
+
+            try:
+                if os.path.getsize(job.writepath) != job.size:
+                    job.open(self._threadpool)
+            except Exception as exp:
+                self._job_failed(job, exp)
+
+        digest, exp = apply_returning_errors(self._threadpool, hash_file_range,
+                                             job.writepath, chunk.offset, chunk.cb_original)
+
+        if exp is not None:
+            LOG.debug("Failed verifying chunk in %s: %s", job.writepath, exp)
+
+        if not job.error:
+            metrics.inc('steamctl_verify_chunks_total', result='hit' if digest == chunk.sha else 'miss')
+
+        if digest == chunk.sha or job.error:
+            if not job.error:
+                self._chunk_locations.setdefault(chunk.sha, (job.writepath, chunk.offset))
+                job.journal.record(job.file_index, chunk_index)
+                self.pbar.update(chunk.cb_original)
+
+            self._chunk_finished(job)
+        else:
+            self._fetch_items.append((job, (chunk_index, chunk)))
+            self._fetch_event.set()
+
+    def _worker(self):
+        while True:
+            if self._fetch_items:
+                job, item = self._fetch_items.popleft()
+            else:
+                job, item = self._next_item(self._queue)
+
+            # wait for chunks that still need to be verified
+            if job is None:
+                if not self._verifying:
+                    return
+
+                self._fetch_event.clear()
+                self._fetch_event.wait()
+                continue
+
+            if isinstance(job, VPKArchiveJob):
+                self._download_vpk_chunk(job, item)
+            elif item is None:
+                self._download_empty_file(job)
+            else:
+                self._download_chunk(job, *item)
+
+    def _download_empty_file(self, job):
+        try:
+            job.open(self._threadpool)
+            job.close()
+        except Exception as exp:
+            self._job_failed(job, exp)
+        else:
+            job.done = True
+            self._completed.append(job)
+            self.pbar_files.update(1)
+
+    def _download_chunk(self, job, chunk_index, chunk):
+        # both the compressed and decoded chunk can be in memory at once
+        nbytes = chunk.cb_compressed + chunk.cb_original
+        acquired = queued = False
+
+        try:
+            if job.error:
+                return
+
+            self.memory.acquire(nbytes)
+            acquired = True
+            job.open(self._threadpool)
+
+            # copy chunk if we already have it on disk, otherwise download it
+            data = self._read_local_chunk(chunk)
+
+            if data is None:
+                manifest = job.depotfile.manifest
+
+                try:
+                    with self.connections.request() as request:
+                        data = manifest.cdn_client.get_chunk(manifest.app_id,
+                                                             manifest.depot_id,
+                                                             chunk.sha.hex(),
+                                                             )
+                        request.nbytes = chunk.cb_compressed
+                except Exception as exp:
+                    # the rest of the file is still downloaded, so a later run
+                    # resumes with only the chunks that failed
+                    self._chunk_failed(job, chunk, exp)
+                    return
+
+                self.bytes_downloaded += chunk.cb_original
+            else:
+                self.bytes_reused += chunk.cb_original
+                metrics.inc('steamctl_reused_bytes_total', chunk.cb_original, source='local')
+
+            if job.error:
+                return
+
+            def written(error, job=job, chunk_index=chunk_index, chunk=chunk):
+                self.memory.release(nbytes)
+
+                if error is None:
+                    self._chunk_locations.setdefault(chunk.sha, (job.writepath, chunk.offset))
+                    job.journal.record(job.file_index, chunk_index)
+                    self.pbar.update(chunk.cb_original)
+
+            queued = True
+            job.write(data, chunk.offset, written)
+        except Exception as exp:
+            self._job_failed(job, exp)
+        finally:
+            if acquired and not queued:
+                self.memory.release(nbytes)
+
+            self._chunk_finished(job)
+
+    def _read_local_chunk(self, chunk):
+        location = self._chunk_locations.get(chunk.sha)
+
+        if location is None:
+            return
+
+        filepath, offset = location
+
+        data, exp = apply_returning_errors(self._threadpool, read_file_range, filepath, offset, chunk.cb_original)
+
+        if exp is not None:
+            LOG.debug("Failed reading chunk from %s: %s", filepath, exp)
+            data = b''
+
+        if self._threadpool.apply(sha1, (data,)).digest() != chunk.sha:
+            self._chunk_locations.pop(chunk.sha, None)
+            return
+
+        return data
+
+    def _chunk_finished(self, job):
+        job.pending -= 1
+
+        if job.pending == 0:
+            try:
+                job.close()
+            except Exception as exp:
+                self._job_failed(job, exp)
+
+            if job.failed_chunks and not job.error:
+                self._job_failed(job, SteamError("{} chunk(s) failed".format(job.failed_chunks)))
+
+            if not job.error:
+                job.done = True
+                self._completed.append(job)
+                self.pbar_files.update(1)
+
+    def _chunk_failed(self, job, chunk, exp):
+        LOG.debug("Failed to fetch chunk %s for %s: %s", chunk.sha.hex(), job.filepath, exp)
+        metrics.inc('steamctl_failed_chunks_total')
+        job.failed_chunks += 1
+        job.journal.incomplete = True
+        self.failed_chunks.append((job, chunk, exp))
+
+    def report_failed(self):
+        """Log a summary of the files and chunks that failed to download"""
+        if not self.failed:
+            return
+
+        LOG.error("Failed to download %s file(s):", len(self.failed))
+
+        for job in self.failed:
+            LOG.error("  %s: %s", job.filepath, job.error)
+
+        for job, chunk, exp in self.failed_chunks:
+            LOG.error("  %s chunk %s (offset %s, %s): %s",
+                      job.filepath, chunk.sha.hex(), chunk.offset, fmt_size(chunk.cb_original), exp)
+
+    def _job_failed(self, job, exp):
+        if job.error:
+            return
+
+        LOG.error("Failed to download %s: %s", job.filepath, exp)
+        job.error = exp
+        self.failed.append(job)
+
+        # drop chunks that haven't been picked up by a worker yet
+        if isinstance(job, DepotFileJob):
+            job.pending -= len(job.chunks)
+            job.chunks.clear()
+            job.journal.incomplete = True
+
+    def _coalesce_vpk(self, queue):
+        # group VPK entries by archive, in place of the first entry from each
+        archives = {}
+
+        for job in queue:
+            if isinstance(job, VPKFileJob):
+                archives.setdefault(job.archive_path, []).append(job)
+
+        if not archives:
+            return queue
+
+        coalesced = deque()
+
+        for job in queue:
+            if not isinstance(job, VPKFileJob):
+                coalesced.append(job)
+            elif job.archive_path in archives:
+                entries = archives.pop(job.archive_path)
+
+                try:
+                    archive = job.fvpk.fopen(job.archive_path, 'rb')
+                    archive_job = VPKArchiveJob(archive, entries)
+                except Exception as exp:
+                    for entry in entries:
+                        self._job_failed(entry, exp)
+                    continue
+
+                LOG.debug("Extracting %s VPK file(s) from %s chunk(s) of %s",
+                          len(entries), len(archive_job.chunks), job.archive_path)
+
+                # create files with their preload data, those without archive data are done
+                errors = self._threadpool.apply(write_ranges, ([(entry.filepath, entry.size, entry.metadata[0])
+                                                                for entry in entries
+                                                                if not entry.error],
+                                                               True))
+
+                for entry in entries:
+                    if entry.error:
+                        exp, entry.error = entry.error, None
+                        self._job_failed(entry, exp)
+                    elif entry.filepath in errors:
+                        self._job_failed(entry, errors[entry.filepath])
+                    else:
+                        self.pbar.update(entry.metadata[2])
+
+                        if entry.pending == 0:
+                            self.pbar_files.update(1)
+
+                coalesced.append(archive_job)
+
+        return coalesced
+
+    def _download_vpk_chunk(self, job, item):
+        if item is None:
+            return  # only preload data
+
+        chunk, pieces = item
+        nbytes = chunk.cb_compressed + chunk.cb_original
+        self.memory.acquire(nbytes)
+
+        try:
+            data = self._read_local_chunk(chunk)
+
+            if data is None:
+                manifest = job.archive.manifest
+
+                with self.connections.request() as request:
+                    data = manifest.cdn_client.get_chunk(manifest.app_id,
+                                                         manifest.depot_id,
+                                                         chunk.sha.hex(),
+                                                         )
+                    request.nbytes = chunk.cb_compressed
+
+            # slices of one chunk for many entries are written in a single thread pool call
+            view = memoryview(data)
+            errors = self._threadpool.apply(write_ranges, ([(entry.filepath, offset, view[start:end])
+                                                            for entry, start, end, offset in pieces
+                                                            if not entry.error],))
+        except Exception as exp:
+            errors = {entry.filepath: exp for entry, _, _, _ in pieces}
+        finally:
+            self.memory.release(nbytes)
+
+        for entry, start, end, _ in pieces:
+            entry.pending -= 1
+
+            if entry.filepath in errors:
+                self._job_failed(entry, errors[entry.filepath])
+            elif not entry.error:
+                self.pbar.update(end - start)
+
+                if entry.pending == 0:
+                    self.pbar_files.update(1)
+
+    def plan(self):
+        """Work out what :meth:`run` would do, without downloading or writing anything
+
+        Existing files are verified (read only), so the estimate is byte accurate.
+        Chunks are counted once: the first occurrence is fetched, unless a copy is
+        already on disk or in the chunk store, and later occurrences are copied.
+
+        :returns: plan with totals, and a list of files
+        :rtype: dict
+        """
+        plan = {
+            'files': self.total_files,
+            'files_unchanged': self.files_unchanged,
+            'size': self.total_size,
+            'chunks': 0,
+            'unique_chunks': 0,
+            'bytes_present': self.bytes_unchanged + self.bytes_resumed,
+            'bytes_reused': 0,
+            'bytes_from_chunk_store': 0,
+            'bytes_to_fetch': 0,
+            'bytes_to_fetch_compressed': 0,
+            'vpk_files': 0,
+            'vpk_bytes': 0,
+            'files_linked': len(self._links),
+            'bytes_linked': sum(job.size for job in self._links),
+            'disk_required': 0,
+            'file_list': [],
+        }
+
+        jobs = list(self._verify_queue) + list(self._queue)
+        missing = {}  # job -> chunks that need data
+
+        self._threadpool = ThreadPool(self.verify_threads)
+
+        def verify_job(job):
+            missing[job] = []
+
+            for chunk_index, chunk in job.chunks:
+                digest, _ = apply_returning_errors(self._threadpool, hash_file_range,
+                                                   job.writepath, chunk.offset, chunk.cb_original)
+
+                if digest == chunk.sha:
+                    self._chunk_locations.setdefault(chunk.sha, (job.writepath, chunk.offset))
+                    plan['bytes_present'] += chunk.cb_original
+                else:
+                    missing[job].append(chunk)
+
+        try:
+            GPool(self.verify_threads * 2).map(verify_job, self._verify_queue)
+        finally:
+            self._threadpool.kill()
+
+        seen = set()
+        archives = {}  # archive path -> VPK entries
+
+        def count_chunks(chunks, manifest):
+            chunk_store = manifest.cdn_client.chunk_store
+
+            for chunk in chunks:
+                if chunk.sha in seen or chunk.sha in self._chunk_locations:
+                    plan['bytes_reused'] += chunk.cb_original
+                elif chunk_store and chunk_store.has(manifest.depot_id, chunk.sha.hex()):
+                    plan['bytes_from_chunk_store'] += chunk.cb_original
+                else:
+                    plan['bytes_to_fetch'] += chunk.cb_original
+                    plan['bytes_to_fetch_compressed'] += chunk.cb_compressed
+
+                seen.add(chunk.sha)
+
+        for job in jobs:
+            if isinstance(job, VPKFileJob):
+                archives.setdefault(job.archive_path, []).append(job)
+                plan['vpk_files'] += 1
+                plan['vpk_bytes'] += job.size
+                plan['disk_required'] += job.size
+                plan['file_list'].append({'path': job.filepath, 'size': job.size, 'vpk': True})
+                continue
+
+            chunks = missing[job] if job in missing else [chunk for _, chunk in job.chunks]
+            count_chunks(chunks, job.depotfile.manifest)
+            plan['chunks'] += len(job.depotfile.chunks)
+
+            # staged files are written next to the old file, others grow in place
+            if job.writepath == job.filepath and os.path.isfile(job.filepath):
+                plan['disk_required'] += max(0, job.size - os.path.getsize(job.filepath))
+            else:
+                plan['disk_required'] += job.size
+
+            plan['file_list'].append({'path': job.filepath,
+                                      'size': job.size,
+                                      'chunks': len(job.depotfile.chunks),
+                                      'chunks_needed': len(chunks),
+                                      'sha1': job.depotfile.file_mapping.sha_content.hex(),
+                                      })
+
+        # VPK entries are extracted from the archive chunks that cover them
+        for archive_path, entries in archives.items():
+            try:
+                archive = entries[0].fvpk.fopen(archive_path, 'rb')
+                archive_job = VPKArchiveJob(archive, entries)
+            except Exception as exp:
+                LOG.debug("Can't plan extraction from %s: %s", archive_path, exp)
+                continue
+
+            count_chunks([chunk for chunk, _ in archive_job.chunks], archive.manifest)
+            plan['chunks'] += len(archive_job.chunks)
+
+        for job in self._links:
+            plan['file_list'].append({'path': job.filepath, 'size': job.size, 'link': job.source_path})
+
+        plan['unique_chunks'] = len(seen)
+        return plan
+
+    def _ordered(self, jobs):
+        key = self.orders[self.order]
+        return deque(sorted(jobs, key=key) if key else jobs)
+
+    def _move_staged(self, priority=None):
+        # move staged delta files into place
+        remaining = []
+
+        for job in self._staged:
+            if priority is not None and job.priority != priority:
+                remaining.append(job)
+            elif job.error:
+                if os.path.exists(job.writepath):
+                    os.remove(job.writepath)
+            else:
+                os.replace(job.writepath, job.filepath)
+
+        self._staged = remaining
+
+    def _link_jobs(self, priority=None):
+        """Link files whose source is ready. Without ``priority``, this is the final pass"""
+        remaining = []
+        linked = []
+
+        for job in self._links:
+            if priority is not None and job.priority != priority:
+                remaining.append(job)
+                continue
+
+            source = job.source
+
+            if isinstance(source, DepotFileJob) and not source.done:
+                if priority is not None and not source.error:
+                    remaining.append(job)  # source is downloaded in a later phase
+                else:
+                    self._job_failed(job, SteamError("Source file failed: {}".format(source.filepath)))
+                continue
+
+            try:
+                method = link_file(job.source_path, job.filepath, self.link)
+            except Exception as exp:
+                self._job_failed(job, exp)
+                continue
+
+            LOG.debug("Linked %s -> %s (%s)", job.filepath, job.source_path, method)
+            self.files_linked += 1
+            self.bytes_linked += job.size
+            metrics.inc('steamctl_reused_bytes_total', job.size, source='link')
+            self._completed.append(job)
+            self.pbar_files.update(1)
+            linked.append(job)
+
+        self._links = remaining
+        return linked
+
+    def _fsync_jobs(self, jobs):
+        paths = [job.filepath for job in jobs if not job.error]
+
+        # directories can only be opened for fsync where O_DIRECTORY exists, not on Windows
+        if hasattr(os, 'O_DIRECTORY'):
+            paths += sorted(set(map(os.path.dirname, paths)))
+
+        for path in paths:
+            exp = self._threadpool.apply(fsync_path, (path,))
+
+            if exp:
+                LOG.debug("Failed to fsync %s: %s", path, exp)
+
+    def _run_phase(self):
+        self._fetch_event.clear()
+        self._verifying = self.verify_threads * 2 if self._verify_queue else 0
+
+        # extra verify workers keep the next read queued up for each thread
+        workers = [gevent.spawn(self._verify_worker) for _ in range(self._verifying)]
+        workers += [gevent.spawn(self._worker) for _ in range(self.connections.maximum)]
+        gevent.joinall(workers, raise_error=True)
+        self._writer.join()
+
+    def run(self):
+        """Download everything that has been queued, returns once all workers are done"""
+        self.pbar.update(self.bytes_resumed)
+        metrics.inc('steamctl_reused_bytes_total', self.bytes_unchanged, source='unchanged')
+        metrics.inc('steamctl_reused_bytes_total', self.bytes_resumed, source='resumed')
+
+        self._make_dirs()
+
+        # sources are downloaded in the phase of the first file linked to them
+        for job in self._links:
+            if isinstance(job.source, DepotFileJob):
+                job.source.priority = min(job.source.priority, job.priority)
+
+        verify_jobs, jobs = self._verify_queue, self._queue
+        priorities = sorted(set(job.priority for job in verify_jobs + jobs))
+
+        # files are about to change, they need to be verified again
+        for job in verify_jobs + jobs:
+            if isinstance(job, DepotFileJob):
+                self.state.forget(job.filepath)
+
+        self.state.commit()
+        self._threadpool = ThreadPool(self.verify_threads)
+
+        try:
+            for priority in priorities:
+                self._verify_queue = self._ordered(job for job in verify_jobs if job.priority == priority)
+                queue = self._ordered(job for job in jobs if job.priority == priority)
+                phase_jobs = list(self._verify_queue) + list(queue)
+                self._queue = self._coalesce_vpk(queue)
+
+                self._run_phase()
+
+                # priority files are complete and on disk, before the rest starts
+                if priority < len(self.priorities):
+                    self._move_staged(priority)
+                    phase_jobs += self._link_jobs(priority)
+                    self._fsync_jobs(phase_jobs)
+                    LOG.info("Priority files (%s) are written: %s file(s)",
+                             ' '.join(self.priorities[priority]),
+                             len(phase_jobs),
+                             )
+        finally:
+            self._writer.join()
+            self._threadpool.kill()
+            self._verify_queue, self._queue = deque(), deque()
+
+            for journal in self._journals.values():
+                journal.close()
+
+        self._move_staged()
+        self._link_jobs()
+
+        # record after all writes are done, so files are not within the racy window
+        for job in self._completed:
+            try:
+                self.state.record(job.filepath, job.depotfile.manifest.gid, job.depotfile.file_mapping)
+            except (sqlite3.Error, OSError) as exp:
+                LOG.debug("Failed recording install state for %s: %s", job.filepath, exp)
+
+        self._completed = []
+        self.state.close()
+
+        # journals are only needed until a manifest has been downloaded completely
+        for journal in self._journals.values():
+            if not journal.incomplete:
+                journal.remove()
+
+        self._journals = {}
+
+        try:
+            os.rmdir(os.path.join(self.target, STATE_DIR))
+        except OSError:
+            pass  # not empty or doesn't exist
+
+
+class _ChunkReader(object):
+    """File object reading a depot file from the chunks :class:`TarStreamer` fetched ahead"""
+    def __init__(self, streamer, ahead, count):
+        self._streamer = streamer
+        self._ahead = ahead
+        self._count = count  # chunks left to take from the queue
+        self._view = memoryview(b'')
+
+    def _next(self):
+        result, nbytes = self._ahead.get()
+        self._count -= 1
+
+        try:
+            data = result.get()
+        finally:
+            self._streamer.memory.release(nbytes)
+
+        self._streamer.pbar.update(len(data))
+        return data
+
+    def read(self, size):
+        parts = []
+
+        while size and (self._view or self._count):
+            if not self._view:
+                self._view = memoryview(self._next())
+
+            part = self._view[:size]
+            self._view = self._view[len(part):]
+            parts.append(part)
+            size -= len(part)
+
+        return b''.join(parts)
+
+
+class TarStreamer(object):
+    """Streams depot files into a tar archive, in the order they are queued,
+    without writing anything to disk
+
+    Chunks are fetched concurrently ahead of the file being written, limited by
+    ``max_memory`` and :attr:`read_ahead`, and written out in order. The archive
+    can go to a pipe, as it is never seeked.
+
+    The counters match :class:`DepotDownloader`, so callers can use either.
+
+    :param fileobj: binary file object to write the archive to
+    :type  fileobj: file
+    :param no_make_dirs: store files without their directories
+    :type  no_make_dirs: bool
+    :param max_connections: maximum number of concurrent chunk requests
+    :type  max_connections: int
+    :param max_memory: budget in bytes for chunk data fetched ahead, ``0`` for unlimited
+    :type  max_memory: int
+    """
+    read_ahead = 256  #: maximum number of chunks fetched ahead of the one being written
+
+    def __init__(self, fileobj, no_make_dirs=False, max_connections=32, max_memory=0):
+        self.fileobj = fileobj
+        self.no_make_dirs = no_make_dirs
+        self.connections = AdaptiveConcurrency(initial=6, maximum=max_connections)
+        self.memory = MemoryBudget(max_memory)
+        self.pbar = fake_tqdm()
+        self.pbar_files = fake_tqdm()
+        self.total_files = 0
+        self.total_size = 0
+        self.failed = []
+        self.files_unchanged = 0
+        self.files_linked = 0
+        self.bytes_reused = 0
+        self._entries = []  # (tarinfo, depot file or VPKFileJob)
+
+    def __repr__(self):
+        return "<%s(files=%r, size=%r)>" % (
+            self.__class__.__name__,
+            self.total_files,
+            self.total_size,
+            )
+
+    def _make_name(self, relpath, prefix=''):
+        relpath = sanitizerelpath(relpath)
+
+        if self.no_make_dirs:
+            relpath = os.path.basename(relpath)
+        else:
+            relpath = os.path.join(prefix, relpath)
+
+        return relpath.replace(os.sep, '/')
+
+    def queue_file(self, depotfile):
+        info = tarfile.TarInfo(self._make_name(depotfile.filename))
+        info.size = depotfile.size
+        info.mtime = depotfile.manifest.creation_time
+        info.mode = 0o755 if depotfile.flags & EDepotFileFlag.Executable else 0o644
+
+        self._entries.append((info, depotfile))
+        self.total_files += 1
+        self.total_size += depotfile.size
+
+    def queue_vpkfile(self, vpk_path, fvpk, vpkfile_path, metadata):
+        job = VPKFileJob(fvpk, vpkfile_path, metadata,
+                         self._make_name(vpkfile_path, prefix=vpk_path[:-4]),
+                         )
+
+        info = tarfile.TarInfo(job.filepath)
+        info.size = job.size
+        info.mode = 0o644
+
+        self._entries.append((info, job))
+        self.total_files += 1
+        self.total_size += job.size
+        return job
+
+    def _prefetch(self, pool, ahead):
+        for _, source in self._entries:
+            if isinstance(source, VPKFileJob):
+                continue  # read from the VPK when it is written
+
+            for chunk in sorted(source.chunks, key=lambda chunk: chunk.offset):
+                nbytes = chunk.cb_compressed + chunk.cb_original
+                self.memory.acquire(nbytes)
+
+                result = AsyncResult()
+                pool.spawn(self._fetch_chunk, source.manifest, chunk, result)
+                ahead.put((result, nbytes))
+
+    def _fetch_chunk(self, manifest, chunk, result):
+        try:
+            with self.connections.request() as request:
+                data = manifest.cdn_client.get_chunk(manifest.app_id,
+                                                     manifest.depot_id,
+                                                     chunk.sha.hex(),
+                                                     )
+                request.nbytes = chunk.cb_compressed
+        except Exception as exp:
+            result.set_exception(exp)
+        else:
+            result.set(data)
+
+    def run(self):
+        """Fetch and write everything that has been queued, then end the archive
+
+        :raises SteamError: when a file could not be fetched, the archive is left unfinished
+        """
+        ahead = Queue(self.read_ahead)
+        pool = GPool(self.connections.maximum)
+        prefetcher = gevent.spawn(self._prefetch, pool, ahead)
+
+        try:
+            with tarfile.open(fileobj=self.fileobj, mode='w|', format=tarfile.PAX_FORMAT,
+                              copybufsize=1024**2) as tar:
+                for info, source in self._entries:
+                    try:
+                        if isinstance(source, VPKFileJob):
+                            tar.addfile(info, source.fvpk.get_vpkfile_instance(
+                                                    source.vpkfile_path,
+                                                    source.fvpk._make_meta_dict(source.metadata)))
+                            self.pbar.update(info.size)
+                        else:
+                            tar.addfile(info, _ChunkReader(self, ahead, len(source.chunks)))
+                    except Exception as exp:
+                        raise SteamError("Failed to stream {}: {}".format(info.name, exp))
+
+                    self.pbar_files.update(1)
+        finally:
+            prefetcher.kill()
+            pool.kill()
+
@@ -0,0 +1,187 @@
+import logging
+from time import time
+from contextlib import contextmanager
+from gevent.event import Event
+from steamctl.utils.ratelimit import throttled_time
+
+_LOG = logging.getLogger(__name__)
+
+
+def apply_returning_errors(pool, func, *args):
+    """Call ``func(*args)`` in a thread pool, and return ``(result, exception)``
+
+    The thread pool prints the traceback of anything raised in it, so errors are
+    caught in the thread and handed back instead. Without a ``pool``, ``func`` runs inline.
+
+    :param pool: pool to call ``func`` in, or ``None``
+    :type  pool: :class:`gevent.threadpool.ThreadPool`
+    """
+    def call():
+        try:
+            return func(*args), None
+        except Exception as exp:
+            return None, exp
+
+    return pool.apply(call) if pool is not None else call()
+
+
+class _Request(object):
+    nbytes = 0
+
+
+class MemoryBudget(object):
+    """Limits the number of bytes buffered in memory at once, across everything using it
+
+    :meth:`acquire` waits while the budget is used up. A single request larger than
+    the whole budget is let through once nothing else is held, so it can't deadlock.
+
+    :param limit: budget in bytes, ``0`` for unlimited
+    :type  limit: int
+    """
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._released = Event()
+
+    def __repr__(self):
+        return "%s(limit=%r, used=%r)" % (
+            self.__class__.__name__,
+            self.limit,
+            self.used,
+            )
+
+    def acquire(self, nbytes):
+        while self.limit and self.used and self.used + nbytes > self.limit:
+            self._released.clear()
+            self._released.wait()
+
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+
+    def release(self, nbytes):
+        self.used -= nbytes
+        self._released.set()
+
+
+class AdaptiveConcurrency(object):
+    """Limits the number of concurrent requests, and adjusts the limit based on measured
+    throughput, latency and error rate (additive increase, multiplicative decrease)
+
+    Every ``interval`` seconds the last window of requests is evaluated:
+
+    * any errors halve the limit
+    * average latency over twice the best seen cuts the limit by a quarter
+    * if the limit was reached, and either throughput improved or latency is
+      still close to the best seen, the limit grows by one
+
+    :param initial: starting limit
+    :type  initial: int
+    :param minimum: lowest limit
+    :type  minimum: int
+    :param maximum: highest limit
+    :type  maximum: int
+    :param interval: seconds between adjustments
+    :type  interval: float
+    """
+    def __init__(self, initial=6, minimum=1, maximum=32, interval=2):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = max(minimum, min(initial, self.maximum))
+        self.interval = interval
+        self.active = 0
+        self._released = Event()
+        self._last_throughput = 0
+        self._best_latency = None
+        self._reset_window(time())
+
+    def __repr__(self):
+        return "%s(limit=%r, active=%r)" % (
+            self.__class__.__name__,
+            self.limit,
+            self.active,
+            )
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._bytes = 0
+        self._latency = 0
+        self._requests = 0
+        self._errors = 0
+        self._saturated = self.active >= self.limit
+
+    def acquire(self):
+        while self.active >= self.limit:
+            self._released.clear()
+            self._released.wait()
+
+        self.active += 1
+
+        if self.active >= self.limit:
+            self._saturated = True
+
+    def release(self, nbytes=0, latency=0, error=False):
+        self.active -= 1
+        self._bytes += nbytes
+        self._latency += latency
+        self._requests += 1
+        self._errors += 1 if error else 0
+
+        now = time()
+
+        if now - self._window_start >= self.interval:
+            self._adjust(now)
+
+        self._released.set()
+
+    @contextmanager
+    def request(self):
+        """Context manager that holds a slot for the duration of a request.
+        Set ``nbytes`` on the yielded object to the number of bytes transferred.
+
+        Time spent waiting on a rate limit is not counted as latency, otherwise
+        throttling would keep lowering the limit.
+        """
+        self.acquire()
+
+        request = _Request()
+        start = time()
+        throttled = throttled_time()
+
+        def latency():
+            return time() - start - (throttled_time() - throttled)
+
+        try:
+            yield request
+        except Exception:
+            self.release(request.nbytes, latency(), error=True)
+            raise
+        else:
+            self.release(request.nbytes, latency())
+
+    def _adjust(self, now):
+        throughput = self._bytes / (now - self._window_start)
+        latency = self._latency / self._requests
+        limit = self.limit
+
+        if self._errors:
+            limit = limit // 2
+        elif self._best_latency and latency > self._best_latency * 2:
+            limit = limit * 3 // 4
+        elif self._saturated and (throughput > self._last_throughput * 1.05
+                                  or not self._best_latency
+                                  or latency < self._best_latency * 1.25):
+            limit = limit + 1
+
+        limit = max(self.minimum, min(limit, self.maximum))
+
+        if limit != self.limit:
+            _LOG.debug("Concurrency %s -> %s (%.0f B/s, %.3fs latency, %s errors)",
+                       self.limit, limit, throughput, latency, self._errors)
+            self.limit = limit
+
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+
+        self._last_throughput = throughput
+        self._reset_window(now)
@@ -1,4 +1,5 @@
 
+import re
 from math import log
 from functools import reduce
 import dateutil
@@ -59,6 +60,56 @@ def fmt_size(size, decimal_places=0):
 
     return ("{:."+str(decimal_places)+"f} {}").format(size, suffixes[power])
 
+def parse_size(text):
+    """Parse friendly size (e.g. 512M, 10GB, 1.5GiB) into bytes"""
+
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGTP]?)(i?)B?\s*$', str(text), re.I)
+
+    if not match:
+        raise ValueError("Invalid size: {!r}".format(text))
+
+    size, suffix, binary = match.groups()
+    power = ' KMGTP'.index(suffix.upper() or ' ')
+
+    return int(float(size) * ((1024 if binary else 1000) ** power))
+
+def parse_rate(text):
+    """Parse a rate in bytes per second (e.g. 2MB, 500KiB). ``0`` or ``unlimited`` means no limit"""
+    text = str(text).strip()
+
+    if text.lower() in ('', 'unlimited', 'none', 'off'):
+        return 0
+
+    return parse_size(text)
+
+def parse_schedule(text):
+    """Parse a schedule of rates by time of day
+
+    Format is ``HH:MM-HH:MM=RATE`` entries separated by commas, where ranges may wrap
+    past midnight. E.g. ``08:00-23:00=2MB,23:00-08:00=0``
+
+    :returns: list of ``(start_minute, end_minute, rate)``
+    :rtype: list
+    :raises ValueError: on invalid schedule
+    """
+    schedule = []
+
+    for entry in filter(None, map(str.strip, text.split(','))):
+        match = re.match(r'^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)$', entry)
+
+        if not match:
+            raise ValueError("Invalid schedule entry: {!r}".format(entry))
+
+        sh, sm, eh, em, rate = match.groups()
+        start, end = int(sh) * 60 + int(sm), int(eh) * 60 + int(em)
+
+        if int(sm) >= 60 or int(em) >= 60 or start > 24 * 60 or end > 24 * 60:
+            raise ValueError("Invalid time in schedule entry: {!r}".format(entry))
+
+        schedule.append((start, end, parse_rate(rate)))
+
+    return schedule
+
 def fmt_duration(seconds):
     hours, seconds = divmod(seconds, 3600)
     minutes, seconds = divmod(seconds, 60)
@@ -0,0 +1,200 @@
+import os
+import json
+import atexit
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+import gevent
+
+_LOG = logging.getLogger(__name__)
+
+#: default histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: help text for the metrics recorded by steamctl
+DESCRIPTIONS = {
+    'steamctl_fetched_bytes_total': 'Bytes received over the network',
+    'steamctl_reused_bytes_total': 'Bytes that were not fetched, by where they came from instead',
+    'steamctl_request_seconds': 'Time until a response was received, by server',
+    'steamctl_retries_total': 'Requests that were retried, by server',
+    'steamctl_failed_chunks_total': 'Chunks that could not be fetched after all retries',
+    'steamctl_verify_chunks_total': 'Chunks already on disk that were verified, by whether they matched',
+    'steamctl_decode_seconds': 'Time spent decrypting and decompressing chunks',
+    'steamctl_disk_write_seconds': 'Time spent in disk writes',
+    'steamctl_written_bytes_total': 'Bytes written to disk',
+    'steamctl_read_bytes_total': 'Bytes of depot files read without downloading them, e.g. by depot cat',
+}
+
+
+class _Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics(object):
+    """Counters and histograms for transfers, exportable in the Prometheus text
+    format or as JSON
+
+    Metrics are identified by name and labels, and created when first used.
+    Recording is safe from threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> _Histogram
+        self.started = time()
+
+    def __repr__(self):
+        return "%s(counters=%r, histograms=%r)" % (
+            self.__class__.__name__,
+            len(self._counters),
+            len(self._histograms),
+            )
+
+    def inc(self, name, value=1, **labels):
+        """Increment counter ``name`` by ``value``"""
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record ``value`` in histogram ``name``"""
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = _Histogram(BUCKETS)
+
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager that records the time spent in it in histogram ``name``"""
+        start = time()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start, **labels)
+
+    def to_dict(self):
+        """Returns all metrics as a JSON serializable dict"""
+        counters, histograms = {}, {}
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+
+            for (name, labels), hist in sorted(self._histograms.items(), key=lambda x: x[0]):
+                histograms.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': hist.count,
+                    'sum': hist.sum,
+                    'buckets': dict(zip(map(str, hist.buckets), hist.counts)),
+                    })
+
+        return {
+            'started': int(self.started),
+            'elapsed': time() - self.started,
+            'counters': counters,
+            'histograms': histograms,
+            }
+
+    def to_prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append("# HELP %s %s" % (name, DESCRIPTIONS[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        def fmt_labels(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                                     for key, value in labels)
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                header(name, 'counter')
+                lines.append("%s%s %s" % (name, fmt_labels(labels), value))
+
+            for (name, labels), hist in sorted(self._histograms.items(), key=lambda x: x[0]):
+                header(name, 'histogram')
+
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append("%s_bucket%s %s" % (name, fmt_labels(labels, le=bound), count))
+
+                lines.append("%s_bucket%s %s" % (name, fmt_labels(labels, le='+Inf'), hist.count))
+                lines.append("%s_sum%s %s" % (name, fmt_labels(labels), hist.sum))
+                lines.append("%s_count%s %s" % (name, fmt_labels(labels), hist.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write metrics to ``path``, as JSON when it ends with ``.json``,
+        otherwise in the Prometheus text format
+
+        The file is replaced atomically, so a collector never reads a partial file.
+        """
+        if path.endswith('.json'):
+            data = json.dumps(self.to_dict(), indent=4, sort_keys=True) + '\n'
+        else:
+            data = self.to_prometheus()
+
+        tmppath = path + '.tmp'
+
+        with open(tmppath, 'w') as fp:
+            fp.write(data)
+
+        os.replace(tmppath, path)
+
+
+#: metrics recorded by the download paths
+metrics = Metrics()
+
+
+def export_metrics(args, interval=15):
+    """Write :data:`metrics` to ``--metrics-file`` when the process exits,
+    and every ``interval`` seconds until then for the Prometheus format
+    """
+    path = getattr(args, 'metrics_file', None)
+
+    if not path:
+        return
+
+    def write():
+        try:
+            metrics.write(path)
+        except (IOError, OSError) as exp:
+            _LOG.error("Failed writing metrics: %s", exp)
+
+    def write_loop():
+        while True:
+            gevent.sleep(interval)
+            write()
+
+    if not path.endswith('.json'):
+        gevent.spawn(write_loop)
+
+    atexit.register(write)
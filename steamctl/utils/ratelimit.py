@@ -0,0 +1,154 @@
+import os
+import signal
+import logging
+from time import time
+from datetime import datetime
+import gevent
+from gevent.local import local
+from steamctl.utils.format import parse_rate, fmt_size
+
+_LOG = logging.getLogger(__name__)
+
+_local = local()  # per greenlet state
+
+
+def throttled_time():
+    """Seconds the current greenlet has spent waiting in :meth:`RateLimiter.consume`"""
+    return getattr(_local, 'throttled', 0)
+
+
+class RateLimiter(object):
+    """Token bucket limiting the combined rate of all downloads using it
+
+    The rate in effect is taken from the control file (if it has a valid rate in it),
+    then the schedule entry for the current time of day, and lastly the base rate.
+    A rate of ``0`` means no limit.
+
+    :param rate: base rate in bytes per second
+    :type  rate: int
+    :param schedule: rates by time of day, see :func:`steamctl.utils.format.parse_schedule`
+    :type  schedule: list
+    :param control_file: path to a file containing a rate, re-read when it changes
+    :type  control_file: str
+    """
+    check_interval = 1  #: seconds between checking the schedule and control file
+
+    def __init__(self, rate=0, schedule=None, control_file=None):
+        self.base_rate = rate
+        self.schedule = schedule or []
+        self.control_file = control_file
+        self._control_rate = None
+        self._control_mtime = None
+        self._checked = 0
+        self._rate = rate
+        self._tokens = 0
+        self._last = time()
+
+    def __repr__(self):
+        return "%s(rate=%r)" % (
+            self.__class__.__name__,
+            self.rate,
+            )
+
+    def __bool__(self):
+        return bool(self.base_rate or self.schedule or self.control_file)
+
+    __nonzero__ = __bool__
+
+    def reload(self):
+        """Force the control file and schedule to be checked on next use"""
+        self._control_mtime = None
+        self._checked = 0
+
+    def _read_control_file(self):
+        try:
+            mtime = os.stat(self.control_file).st_mtime
+        except OSError:
+            self._control_rate = self._control_mtime = None
+            return
+
+        if mtime == self._control_mtime:
+            return
+
+        self._control_mtime = mtime
+
+        try:
+            with open(self.control_file) as fp:
+                self._control_rate = parse_rate(fp.read())
+        except (OSError, ValueError) as exp:
+            _LOG.error("Ignoring rate limit control file: %s", exp)
+            self._control_rate = None
+
+    def _scheduled_rate(self):
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+
+        for start, end, rate in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+
+        return self.base_rate
+
+    @property
+    def rate(self):
+        """Rate in bytes per second currently in effect"""
+        now = time()
+
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+
+            if self.control_file:
+                self._read_control_file()
+
+            rate = self._control_rate if self._control_rate is not None else self._scheduled_rate()
+
+            if rate != self._rate:
+                _LOG.info("Download rate limit: %s", "%s/s" % fmt_size(rate, 1) if rate else "unlimited")
+                self._rate = rate
+
+        return self._rate
+
+    def read_size(self, default):
+        """Size for reads that are followed by :meth:`consume`, keeps bursts under a second"""
+        rate = self.rate
+        return max(65536, min(default, rate)) if rate else default
+
+    def consume(self, nbytes):
+        """Take ``nbytes`` from the bucket, sleeping when the bucket is in debt"""
+        rate = self.rate
+        now = time()
+
+        if not rate:
+            self._tokens = 0
+            self._last = now
+            return
+
+        # bucket holds at most one second worth of tokens
+        self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+        self._last = now
+        self._tokens -= nbytes
+
+        if self._tokens < 0:
+            delay = -self._tokens / rate
+            _local.throttled = throttled_time() + delay
+            gevent.sleep(delay)
+
+    def install_signal_handler(self, signum=getattr(signal, 'SIGHUP', None)):
+        """Re-read the control file when the process receives ``signum`` (SIGHUP by default)"""
+        if signum is not None:
+            gevent.signal_handler(signum, self.reload)
+
+
+def make_rate_limiter(args):
+    """Create :class:`RateLimiter` from ``--limit-rate``, ``--limit-schedule``
+    and ``--limit-file`` arguments
+    """
+    limiter = RateLimiter(getattr(args, 'limit_rate', 0) or 0,
+                          getattr(args, 'limit_schedule', None),
+                          getattr(args, 'limit_file', None),
+                          )
+
+    if limiter.control_file:
+        limiter.install_signal_handler()
+
+    return limiter
@@ -2,14 +2,18 @@
 import os
 import re
 import json
+import zlib
+import struct
 import logging
+import threading
 from time import time
 from io import open
 from contextlib import contextmanager
 import fnmatch
 import shutil
-from collections import UserDict
+from collections import UserDict, OrderedDict
 import sqlite3
+from hashlib import sha1
 from appdirs import AppDirs
 from steamctl import __appname__
 
@@ -165,6 +169,222 @@ class UserCacheDirectory(DirectoryBase):
     _file_type = UserCacheFile
 
 
+class ChunkStore(object):
+    """Content addressable store for decoded depot chunks, located in the user cache directory
+
+    Chunks are keyed by depot id and chunk sha. Access times are tracked via file mtime.
+    The least recently used chunks are evicted as new ones are stored, to stay within
+    ``max_size``. Methods are safe to call from threads.
+    """
+    def __init__(self, relpath='chunks', max_size=0):
+        self.directory = UserCacheDirectory(relpath)
+        self.path = self.directory.path
+        self.max_size = max_size
+        self.size = 0
+        self._entries = None  # path -> size, least recently used first
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s(%r, max_size=%r)" % (
+            self.__class__.__name__,
+            self.path,
+            self.max_size,
+            )
+
+    def _chunk_path(self, depot_id, chunk_id):
+        return os.path.join(self.path, str(depot_id), chunk_id[:2], chunk_id)
+
+    def _scan(self):
+        # the store is only scanned once, and tracked in memory after that
+        if self._entries is not None:
+            return
+
+        entries = []
+
+        if self.directory.exists():
+            for root, _, files in os.walk(self.path):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        self._entries = OrderedDict((path, size) for _, size, path in sorted(entries))
+        self.size = sum(self._entries.values())
+
+    def _evict(self):
+        if not self.max_size or self.size <= self.max_size:
+            return
+
+        _LOG.debug("Chunk store is over budget (%s > %s), pruning", self.size, self.max_size)
+
+        while self._entries and self.size > self.max_size:
+            path, size = self._entries.popitem(last=False)
+            self.size -= size
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def has(self, depot_id, chunk_id):
+        return os.path.exists(self._chunk_path(depot_id, chunk_id))
+
+    def get(self, depot_id, chunk_id):
+        path = self._chunk_path(depot_id, chunk_id)
+
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            return
+
+        if sha1(data).hexdigest() != chunk_id:
+            _LOG.debug("Removing corrupted chunk from store: %s", path)
+
+            # another reader may have removed it already
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            with self._lock:
+                if self._entries is not None and path in self._entries:
+                    self.size -= self._entries.pop(path)
+            return
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # evicted since it was read
+
+        with self._lock:
+            if self._entries is not None and path in self._entries:
+                self._entries.move_to_end(path)
+
+        return data
+
+    def put(self, depot_id, chunk_id, data):
+        path = self._chunk_path(depot_id, chunk_id)
+        ensure_dir(path, 0o700)
+
+        with open(path + '.tmp', 'wb') as fp:
+            fp.write(data)
+
+        os.replace(path + '.tmp', path)
+
+        if not self.max_size:
+            return
+
+        with self._lock:
+            self._scan()
+            self.size += len(data) - self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            self._evict()
+
+    def prune(self):
+        """Remove least recently used chunks until the store fits in ``max_size``"""
+        if not self.max_size:
+            return
+
+        with self._lock:
+            self._scan()
+            self._evict()
+
+
+class VPKIndexCache(object):
+    """Parsed VPK directory indexes, keyed by the sha1 of the ``_dir.vpk`` file content,
+    in an SQLite database located in the user cache directory
+
+    Each index is stored packed and compressed in a single row, next to the header
+    fields of the VPK. Only the ``max_indexes`` most recently used are kept.
+    """
+    _record = struct.Struct('<HIHHII')  # path length, crc32, preload length, archive index, archive offset, file length
+    _header = struct.Struct('<7I')
+    header_fields = ('version', 'tree_length', 'header_length',  # v2 adds the rest
+                     'embed_chunk_length', 'chunk_hashes_length', 'self_hashes_length', 'signature_length')
+
+    def __init__(self, relpath='vpk_index.sqlite3', max_indexes=64):
+        self.file = UserCacheFile(relpath)
+        self.max_indexes = max_indexes
+        self._db = None
+
+    def __repr__(self):
+        return "%s(%r, max_indexes=%r)" % (
+            self.__class__.__name__,
+            self.file.path,
+            self.max_indexes,
+            )
+
+    def _connect(self):
+        if self._db is None:
+            self.file.mkdir()
+            self._db = sqlite3.connect(self.file.path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS vpk_index (sha BLOB PRIMARY KEY, used INTEGER,"
+                             " header BLOB, data BLOB)")
+
+        return self._db
+
+    def get(self, sha):
+        """Returns ``(header, index)``, with the header fields in a dict and the index
+        as ``{path: metadata}``, or ``None`` when not cached
+        """
+        db = self._connect()
+        row = db.execute("SELECT header, data FROM vpk_index WHERE sha = ?", (sha,)).fetchone()
+
+        if row is None:
+            return
+
+        db.execute("UPDATE vpk_index SET used = ? WHERE sha = ?", (int(time()), sha))
+        db.commit()
+
+        header = dict(zip(self.header_fields, self._header.unpack(row[0])))
+        data = zlib.decompress(row[1])
+        tree = {}
+        offset = 0
+
+        while offset < len(data):
+            (path_length,
+             crc32,
+             preload_length,
+             archive_index,
+             archive_offset,
+             file_length,
+             ) = self._record.unpack_from(data, offset)
+            offset += self._record.size
+            path = data[offset:offset + path_length].decode('utf-8')
+            offset += path_length
+            preload = data[offset:offset + preload_length]
+            offset += preload_length
+
+            tree[path] = (preload, crc32, preload_length, archive_index, archive_offset, file_length)
+
+        return header, tree
+
+    def put(self, sha, header, tree):
+        """Store the header fields and an index, as returned by :meth:`get`"""
+        header = self._header.pack(*(header.get(name, 0) for name in self.header_fields))
+        parts = []
+
+        for path, (preload, crc32, preload_length, archive_index, archive_offset, file_length) in tree.items():
+            path = path.encode('utf-8')
+            parts += [self._record.pack(len(path), crc32, preload_length, archive_index, archive_offset, file_length),
+                      path,
+                      preload,
+                      ]
+
+        db = self._connect()
+        db.execute("REPLACE INTO vpk_index VALUES (?, ?, ?, ?)",
+                   (sha, int(time()), header, zlib.compress(b''.join(parts))))
+        db.execute("DELETE FROM vpk_index WHERE sha NOT IN (SELECT sha FROM vpk_index ORDER BY used DESC LIMIT ?)",
+                   (self.max_indexes,))
+        db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
 class SqliteDict(UserDict):
     def __init__(self, path=':memory:'):
         if isinstance(path, FileBase):
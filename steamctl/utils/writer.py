@@ -0,0 +1,169 @@
+import os
+import logging
+from collections import deque
+from time import time
+import gevent
+from gevent.event import Event
+from gevent.threadpool import ThreadPool
+from steamctl.utils.metrics import metrics
+from steamctl.utils.concurrency import apply_returning_errors
+
+_LOG = logging.getLogger(__name__)
+
+
+def pwrite(fd, data, offset):
+    """Write all of ``data`` at ``offset``, without moving the file position"""
+    data = memoryview(data)
+
+    while data:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, data)
+
+        data = data[written:]
+        offset += written
+
+def pwritev(fd, buffers, offset):
+    """Write all ``buffers`` back to back starting at ``offset``, in as few syscalls as possible"""
+    if not hasattr(os, 'pwritev'):
+        return pwrite(fd, b''.join(buffers), offset)
+
+    views = deque(map(memoryview, buffers))
+
+    while views:
+        written = os.pwritev(fd, views, offset)
+        offset += written
+
+        while views and written >= len(views[0]):
+            written -= len(views.popleft())
+
+        if written:
+            views[0] = views[0][written:]
+
+
+class WriteBehind(object):
+    """Performs file writes in a thread pool, so slow disks don't block the event loop
+
+    Writes are queued and return immediately, until ``max_pending`` bytes are waiting
+    to be written. Then callers wait, which applies backpressure to downloads.
+    Each file has at most one write in progress, and queued writes that are adjacent
+    in the file are coalesced into a single ``pwritev``.
+
+    Write errors are raised from :meth:`flush` and :meth:`close`.
+
+    :param threads: number of threads doing writes
+    :type  threads: int
+    :param max_pending: maximum bytes queued before :meth:`write` waits
+    :type  max_pending: int
+    """
+    max_coalesce = 256  #: maximum number of writes coalesced together
+
+    def __init__(self, threads=4, max_pending=64*1024**2):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool = ThreadPool(threads)
+        self._space = Event()
+        self._queues = {}  # fd -> deque of (offset, data, callback)
+        self._done = {}    # fd -> Event, set when there is nothing queued for fd
+        self._errors = {}  # fd -> exception from a failed write
+
+    def __repr__(self):
+        return "%s(pending=%r, files=%r)" % (
+            self.__class__.__name__,
+            self.pending,
+            len(self._queues),
+            )
+
+    def write(self, fd, data, offset, callback=None):
+        """Queue ``data`` to be written at ``offset``
+
+        :param callback: called once the write is done, with the exception if it failed or ``None``
+        :type  callback: callable
+        """
+        while self.pending and self.pending + len(data) > self.max_pending:
+            self._space.clear()
+            self._space.wait()
+
+        if fd in self._errors:
+            if callback:
+                callback(self._errors[fd])
+            return
+
+        self.pending += len(data)
+
+        if fd in self._queues:
+            self._queues[fd].append((offset, data, callback))
+        else:
+            self._queues[fd] = deque([(offset, data, callback)])
+            self._done[fd] = Event()
+            gevent.spawn(self._drain, fd)
+
+    def _drain(self, fd):
+        queue = self._queues[fd]
+
+        try:
+            while queue:
+                offset, data, callback = queue.popleft()
+                buffers, callbacks = [data], [callback]
+                end = offset + len(data)
+
+                # coalesce writes that continue where the previous one ended
+                while queue and queue[0][0] == end and len(buffers) < self.max_coalesce:
+                    _, data, callback = queue.popleft()
+                    buffers.append(data)
+                    callbacks.append(callback)
+                    end += len(data)
+
+                _, exp = apply_returning_errors(self._pool, self._write, fd, buffers, offset)
+
+                if exp is not None:
+                    _LOG.debug("Write to fd %s failed: %s", fd, exp)
+                    self._errors[fd] = exp
+                    self._release(sum(map(len, buffers)) + sum(len(item[1]) for item in queue))
+                    callbacks += [item[2] for item in queue]
+                    queue.clear()
+                else:
+                    self._release(end - offset)
+
+                for callback in callbacks:
+                    if callback:
+                        callback(exp)
+        finally:
+            del self._queues[fd]
+            self._done.pop(fd).set()
+
+    @staticmethod
+    def _write(fd, buffers, offset):
+        start = time()
+        pwritev(fd, buffers, offset)
+        metrics.observe('steamctl_disk_write_seconds', time() - start)
+        metrics.inc('steamctl_written_bytes_total', sum(map(len, buffers)))
+
+    def _release(self, nbytes):
+        self.pending -= nbytes
+        self._space.set()
+
+    def flush(self, fd):
+        """Wait for all queued writes for ``fd``, raises the first write error"""
+        if fd in self._done:
+            self._done[fd].wait()
+
+        if fd in self._errors:
+            raise self._errors.pop(fd)
+
+    def close(self, fd):
+        """Flush and close ``fd``"""
+        try:
+            self.flush(fd)
+        finally:
+            self._pool.apply(os.close, (fd,))
+
+    def join(self):
+        """Wait for all queued writes"""
+        for done in list(self._done.values()):
+            done.wait()
+
+    def kill(self):
+        self._pool.kill()
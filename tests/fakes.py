@@ -0,0 +1,93 @@
+"""Depot manifests and a CDN client serving them from memory, for tests"""
+import os
+import io
+import random
+import zipfile
+import tempfile
+import collections
+from hashlib import sha1
+
+# keep caches and install state of tests out of the user's directories
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='steamctl_cache_')
+os.environ['XDG_DATA_HOME'] = tempfile.mkdtemp(prefix='steamctl_data_')
+
+from steam.core.crypto import symmetric_encrypt
+from steam.core.manifest import DepotManifest
+from steamctl.clients import CachingCDNClient, CTLDepotManifest
+
+KEY = b'k' * 32
+
+
+class FakeResponse(object):
+    ok = True
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeCDNClient(CachingCDNClient):
+    """Serves encoded chunks from :attr:`store`, and counts requests per chunk"""
+    def __init__(self):
+        class Client(object):
+            cell_id = 0
+
+        self.store = {}
+        self.requests = collections.Counter()
+        CachingCDNClient.__init__(self, Client())
+        self.depot_keys = {}
+
+    def fetch_content_servers(self, *args, **kwargs):
+        pass
+
+    def load_licenses(self):
+        pass
+
+    def get_depot_key(self, app_id, depot_id):
+        return KEY
+
+    def cdn_cmd(self, command, args):
+        chunk_id = args.rsplit('/', 1)[1]
+        self.requests[chunk_id] += 1
+        return FakeResponse(self.store[chunk_id])
+
+
+def encode_chunk(data):
+    buf = io.BytesIO()
+
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('z', data)
+
+    return symmetric_encrypt(buf.getvalue(), KEY)
+
+
+def make_manifest(cdn, files, chunk_size=1024, depot_id=1, gid=100):
+    """Manifest for ``files`` (``{name: content}``), with the chunks added to ``cdn``"""
+    manifest = DepotManifest()
+    manifest.metadata.depot_id = depot_id
+    manifest.metadata.gid_manifest = gid
+
+    for name, data in files.items():
+        mapping = manifest.payload.mappings.add()
+        mapping.filename = name
+        mapping.size = len(data)
+        mapping.flags = 0
+        mapping.sha_content = sha1(data).digest() if data else b'\x00' * 20
+
+        for offset in range(0, len(data), chunk_size):
+            piece = data[offset:offset + chunk_size]
+            encoded = encode_chunk(piece)
+            chunk = mapping.chunks.add()
+            chunk.sha = sha1(piece).digest()
+            chunk.offset = offset
+            chunk.cb_original = len(piece)
+            chunk.cb_compressed = len(encoded)
+            chunk.crc = 0
+            cdn.store[chunk.sha.hex()] = encoded
+
+    return CTLDepotManifest(cdn, 10, manifest.serialize(compress=False))
+
+
+def random_bytes(size, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for _ in range(size))
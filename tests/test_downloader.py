@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+from fakes import FakeCDNClient, make_manifest, random_bytes
+from steamctl.downloader import DepotDownloader
+from steamctl.utils.metrics import metrics
+
+
+def counter(name):
+    return metrics.to_dict()['counters'].get(name, [{'value': 0}])[0]['value']
+
+
+class DepotDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.target)
+        self.cdn = FakeCDNClient()
+
+    def test_priority_with_link(self):
+        content = random_bytes(5000, 1)
+        manifest = make_manifest(self.cdn, {
+            'data/dup': content,
+            'bin/a': content,
+            'data/other': random_bytes(3000, 2),
+            })
+
+        downloader = DepotDownloader(self.target, priorities=[['bin/*']], link='hardlink')
+        phases = []
+        downloader._fsync_jobs = lambda jobs: phases.append(sorted(job.filepath for job in jobs))
+
+        for depotfile in manifest:
+            downloader.queue_file(depotfile)
+
+        downloader.run()
+
+        self.assertEqual(downloader.failed, [])
+        self.assertIn(os.path.join(self.target, 'bin', 'a'), phases[0])
+        self.assertEqual(downloader.files_linked, 1)
+
+        for name in ('data/dup', 'bin/a'):
+            with open(os.path.join(self.target, name), 'rb') as fp:
+                self.assertEqual(fp.read(), content)
+
+    def test_verify_truncates_larger_file(self):
+        content = random_bytes(5000, 3)
+        manifest = make_manifest(self.cdn, {'a': content})
+
+        with open(os.path.join(self.target, 'a'), 'wb') as fp:
+            fp.write(content + b'GARBAGE')
+
+        downloader = DepotDownloader(self.target)
+
+        for depotfile in manifest:
+            downloader.queue_file(depotfile)
+
+        downloader.run()
+
+        self.assertEqual(downloader.failed, [])
+        self.assertEqual(sum(self.cdn.requests.values()), 0)
+
+        with open(os.path.join(self.target, 'a'), 'rb') as fp:
+            self.assertEqual(fp.read(), content)
+
+    def test_written_bytes_counted(self):
+        files = {'small': random_bytes(100, 4), 'large': random_bytes(5000, 5)}
+        manifest = make_manifest(self.cdn, files)
+        written = counter('steamctl_written_bytes_total')
+
+        downloader = DepotDownloader(self.target)
+
+        for depotfile in manifest:
+            downloader.queue_file(depotfile)
+
+        downloader.run()
+
+        self.assertEqual(downloader.failed, [])
+        self.assertEqual(counter('steamctl_written_bytes_total') - written, 5100)
+
+    def test_read_bytes_counted(self):
+        content = random_bytes(5000, 6)
+        depotfile = next(iter(make_manifest(self.cdn, {'a': content})))
+        read = counter('steamctl_read_bytes_total')
+
+        self.assertEqual(depotfile.read(1500), content[:1500])
+        self.assertEqual(b''.join(depotfile.stream(1000)), content[1000:])
+        self.assertEqual(counter('steamctl_read_bytes_total') - read, 5500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+import vpk
+from fakes import FakeCDNClient, make_manifest, random_bytes
+from steamctl.commands.depot.gcmds import ManifestFileIndex, c_VPK
+
+
+class ManifestFileIndexTest(unittest.TestCase):
+    def setUp(self):
+        cdn = FakeCDNClient()
+        self.manifest = make_manifest(cdn, {
+            'bin/game.exe': random_bytes(10, 1),
+            'bin/Tool.exe': random_bytes(10, 2),
+            'data/maps/de_dust.bsp': random_bytes(10, 3),
+            'data/maps/cs_office.bsp': random_bytes(10, 4),
+            'readme.txt': random_bytes(10, 5),
+            })
+
+    def test_prefix(self):
+        fileindex = ManifestFileIndex([self.manifest], vpk_index_cache=False)
+        self.assertEqual(sorted(fileindex.iter_prefix('data/maps/')),
+                         ['data/maps/cs_office.bsp', 'data/maps/de_dust.bsp'])
+        self.assertEqual(sorted(fileindex.iter_prefix('bin/g')), ['bin/game.exe'])
+        self.assertEqual(list(fileindex.iter_prefix('missing/')), [])
+
+    def test_glob(self):
+        fileindex = ManifestFileIndex([self.manifest], vpk_index_cache=False)
+        self.assertEqual(fileindex.select(name='data/maps/de_*'), {'data/maps/de_dust.bsp'})
+        self.assertEqual(fileindex.select(name='*.exe'), {'bin/game.exe', 'bin/Tool.exe'})
+        self.assertEqual(fileindex.select(name='readme.txt'), {'readme.txt'})
+        self.assertEqual(fileindex.select(name='bin/tool.exe'), set())
+        self.assertIsNone(fileindex.select())
+
+    def test_regex(self):
+        fileindex = ManifestFileIndex([self.manifest], vpk_index_cache=False)
+        self.assertEqual(fileindex.select(regex=r'^data/maps/cs_'), {'data/maps/cs_office.bsp'})
+        self.assertEqual(fileindex.select(regex=r'^bin/game.*'), {'bin/game.exe'})
+        self.assertEqual(fileindex.select(regex=r'^bin/gx?ame'), {'bin/game.exe'})
+        self.assertEqual(fileindex.select(regex=r'\.bsp$'),
+                         {'data/maps/cs_office.bsp', 'data/maps/de_dust.bsp'})
+        self.assertEqual(fileindex.select(regex=r'^readme|^bin/T'), {'readme.txt', 'bin/Tool.exe'})
+
+    def test_ignore_case(self):
+        fileindex = ManifestFileIndex([self.manifest], case_sensitive=False, vpk_index_cache=False)
+        self.assertEqual(fileindex.select(name='BIN/tool.*'), {'bin/Tool.exe'})
+        self.assertEqual(fileindex.select(regex=r'^Data/Maps/DE_'), {'data/maps/de_dust.bsp'})
+        self.assertTrue(fileindex.file_exists('BIN\\TOOL.EXE'))
+        self.assertEqual(fileindex.get_file('README.TXT').filename, 'readme.txt')
+
+
+class CachedVPKTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cdn = FakeCDNClient()
+
+    def make_vpk(self, files):
+        src = os.path.join(self.tmp, 'src')
+        os.makedirs(src)
+
+        for name, content in files.items():
+            with open(os.path.join(src, name), 'wb') as fp:
+                fp.write(content)
+
+        vpk.new(src).save(os.path.join(self.tmp, 'pak01_dir.vpk'))
+
+        with open(os.path.join(self.tmp, 'pak01_dir.vpk'), 'rb') as fp:
+            return make_manifest(self.cdn, {'pak01_dir.vpk': fp.read()})
+
+    def get_vpk(self, manifest):
+        return ManifestFileIndex([manifest]).get_vpk('pak01_dir.vpk')
+
+    def test_cached_header(self):
+        content = random_bytes(2000, 7)
+        manifest = self.make_vpk({'a.txt': content})
+        parsed = self.get_vpk(manifest)
+        cached = self.get_vpk(manifest)
+
+        self.assertIsInstance(cached, c_VPK)
+        self.assertEqual((cached.signature, cached.version, cached.tree_length, cached.header_length),
+                         (parsed.signature, parsed.version, parsed.tree_length, parsed.header_length))
+        self.assertNotEqual(cached.version, 0)
+        self.assertEqual(cached.get_file('a.txt').read(), content)
+
+    def test_cached_empty_index(self):
+        manifest = self.make_vpk({})
+        self.get_vpk(manifest)
+        cached = self.get_vpk(manifest)
+
+        cached.read_index_iter = None  # must not be parsed again
+        self.assertEqual(list(cached.c_iter_index()), [])
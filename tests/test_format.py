@@ -0,0 +1,17 @@
+import unittest
+from steamctl.utils.format import parse_schedule
+
+
+class ParseScheduleTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(parse_schedule('08:00-23:30=2MB, 23:30-24:00=0'),
+                         [(480, 1410, 2000000), (1410, 1440, 0)])
+
+    def test_invalid_time(self):
+        for text in ('10:75-12:00=1MB', '10:00-12:60=1MB', '25:00-01:00=1MB', '24:30-01:00=1MB'):
+            with self.assertRaises(ValueError, msg=text):
+                parse_schedule(text)
+
+
+if __name__ == '__main__':
+    unittest.main()